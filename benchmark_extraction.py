@@ -0,0 +1,326 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+import extract_contents_forwarded_as_attachements as ex
+
+# REFERENCE EXTRACTION
+#
+# The find_all-based pruning prune_invisible() replaced: every [hidden] element, then every
+# styled element is_truly_invisible() flags, then every element of a hidden CSS class. The
+# bs4 backend must give byte-identical text; the benchmark refuses to report numbers when
+# it does not.
+
+
+def reference_visible_text(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for tag in soup.find_all(attrs={'hidden': True}):
+        tag.decompose()
+    for tag in soup.find_all(style=True):
+        # A descendant of an element removed before it is already gone.
+        if not tag.decomposed and ex.is_truly_invisible(tag)[0]:
+            tag.decompose()
+    hidden_classes = {}
+    for style_tag in soup.find_all('style'):
+        style_content = style_tag.get_text()
+        if style_content:
+            hidden_classes.update(ex.hidden_css_classes(style_content))
+    for class_name in hidden_classes:
+        for element in soup.find_all(class_=class_name):
+            element.decompose()
+    return ex.make_text_converter().handle(str(soup))
+
+
+# SYNTHETIC NEWSLETTERS
+
+NEWSLETTER_STYLE = ('<style>.hide-mobile{display:none} .ghost { visibility : hidden } '
+                    '.cta:hover{color:#fff}</style>')
+
+WORDS = ["deal", "save", "today", "only", "your", "order", "offer", "members", "free", "shipping",
+         "new", "arrivals", "limited", "time", "account", "verify", "reward", "points", "expire", "now"]
+
+
+def _sentence(rng, words=6):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _content(rng, index):
+    # The innermost part of a block: visible copy, and now and then something hidden.
+    parts = [f'<span style="font-size:14px;color:#333">{_sentence(rng)} {index}</span>',
+             f'<a href="https://example.com/{index}" class="cta">{_sentence(rng, 2)}</a>']
+    roll = rng.random()
+    if roll < 0.2:
+        parts.append(f'<span style="display:none">{_sentence(rng)}</span>')
+    elif roll < 0.35:
+        parts.append(f'<p class="hide-mobile">{_sentence(rng)}</p>')
+    elif roll < 0.45:
+        parts.append(f'<span hidden>{_sentence(rng)}</span>')
+    elif roll < 0.55:
+        parts.append(f'<div style="width:0;height:0;overflow:hidden">{_sentence(rng)}</div>')
+    elif roll < 0.65:
+        parts.append(f'<img src="https://example.com/{index}.png" alt="{_sentence(rng, 2)}">')
+    return ''.join(parts)
+
+
+def _wrap(rng, inner, level):
+    # Layout wrappers as email builders emit them. font-size:0 wrappers hide the whitespace
+    # between inline-block columns; the sized span inside keeps their text visible.
+    roll = rng.random()
+    if roll < 0.35:
+        return (f'<table role="presentation" width="100%"><tr><td style="padding:4px">{inner}'
+                '</td></tr></table>')
+    if roll < 0.55:
+        return f'<div style="font-size:0;line-height:0">{inner}</div>'
+    if roll < 0.65:
+        return f'<div style="font-size: 0px">{_sentence(rng, 3)}</div>{inner}'
+    if roll < 0.75:
+        return f'<div class="ghost">{_sentence(rng, 3)}</div>{inner}'
+    if roll < 0.9:
+        return f'<div class="col c{level}" style="margin:0 auto">{inner}</div>'
+    return f'<center>{inner}</center>'
+
+
+def make_newsletter(rng, blocks=40, depth=8):
+    body = [f'<div style="display:none;max-height:0">{_sentence(rng, 12)}</div>']
+    for index in range(blocks):
+        inner = _content(rng, index)
+        for level in range(depth):
+            inner = _wrap(rng, inner, level)
+        body.append(inner)
+    return (f'<html><head>{NEWSLETTER_STYLE}</head><body>' + ''.join(body) + '</body></html>')
+
+
+def make_corpus(documents, blocks, depth, seed=0):
+    rng = random.Random(seed)
+    return [make_newsletter(rng, blocks, depth) for _ in range(documents)]
+
+
+# Messier markup for the identical-output check only: random nesting, unclosed tags, every
+# invisibility rule, and classes that differ from the hidden ones only in case.
+
+RANDOM_TAGS = ['div', 'span', 'p', 'td', 'table', 'tr', 'b', 'a', 'font', 'center']
+RANDOM_STYLES = ['display:none', 'display: none', 'visibility:hidden', 'width:0;height:0', 'font-size:0',
+                 'font-size: 0px', 'font-size:12px', 'font-size: 14px', 'color:red', '', 'FONT-SIZE:0',
+                 'max-width:0; height:0']
+RANDOM_CLASSES = ['hide-mobile', 'Hide-mobile', 'ghost', 'cta', 'ghost cta']
+
+
+RANDOM_TEXT = ['hello', 'world', 'pay now', '&amp;', 'click']
+
+
+def _random_attributes(rng):
+    attributes = ''
+    if rng.random() < 0.4:
+        attributes += f' style="{rng.choice(RANDOM_STYLES)}"'
+    if rng.random() < 0.15:
+        attributes += rng.choice([' hidden', ' hidden="hidden"', ' hidden=""'])
+    if rng.random() < 0.3:
+        attributes += f' class="{rng.choice(RANDOM_CLASSES)}"'
+    return attributes
+
+
+def _random_markup(rng, level):
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        roll = rng.random()
+        if roll < 0.3 or level > 6:
+            out.append(rng.choice(RANDOM_TEXT))
+        elif roll < 0.35:
+            out.append(NEWSLETTER_STYLE)
+        else:
+            tag = rng.choice(RANDOM_TAGS)
+            close = f'</{tag}>' if rng.random() < 0.9 else ''
+            out.append(f'<{tag}{_random_attributes(rng)}>{_random_markup(rng, level + 1)}{close}')
+    return ''.join(out)
+
+
+def make_random_document(rng):
+    return '<html><body>' + _random_markup(rng, 0) + '</body></html>'
+
+
+def check_reference(documents):
+    # Returns the documents for which the bs4 backend and the reference differ.
+    return [html for html in documents
+            if ex.remove_invisible_and_extract_text(html, 'bs4') != reference_visible_text(html)]
+
+
+# BACKEND EQUIVALENCE
+#
+# On well-formed markup the lxml backend gives the same text as the bs4 one. Markup the
+# parsers have to repair is another matter: html.parser never infers an end tag, so an
+# unclosed <td>, <li> or <p> takes every following sibling in as a child, and an <a> stays
+# inside another <a>, while lxml closes them where the HTML spec (and a browser) does.
+# Hiding such an element hides more text under bs4. KNOWN_DIVERGENCES records those cases
+# with what each backend gives.
+
+BLOCK_TAGS = ['div', 'center', 'section']
+INLINE_TAGS = ['span', 'b', 'em', 'font']
+
+KNOWN_DIVERGENCES = [
+    ("unclosed hidden <td> followed by another cell",
+     '<html><body><table><tr><td hidden>promo<td>Pay now</td></tr></table></body></html>',
+     '\n', 'Pay now  \n---\n'),
+    ("unclosed display:none <li> followed by another item",
+     '<html><body><ul><li style="display:none">tracking<li>Verify your account</ul></body></html>',
+     '\n\n', '  * Verify your account\n\n\n'),
+    ("unclosed display:none <p> followed by a block",
+     '<html><body><p style="display:none">preheader<div>Verify your account</div></body></html>',
+     '\n', 'Verify your account\n'),
+    ("<a> nested in a display:none <a>",
+     '<html><body><a href="#" style="display:none">unsubscribe <a href="#">Verify your account</a></a></body></html>',
+     '\n', 'Verify your account\n'),
+]
+
+
+def _well_formed_markup(rng, level, inline=False):
+    # Every tag closed, blocks never inside inline elements or <p>, table cells only in rows.
+    out = []
+    for _ in range(rng.randint(0, 4)):
+        roll = rng.random()
+        if roll < 0.3 or level > 6:
+            out.append(rng.choice(RANDOM_TEXT))
+        elif inline or roll < 0.55:
+            tag = rng.choice(INLINE_TAGS)
+            out.append(f'<{tag}{_random_attributes(rng)}>{_well_formed_markup(rng, level + 1, True)}</{tag}>')
+        elif roll < 0.6:
+            out.append(NEWSLETTER_STYLE)
+        elif roll < 0.7:
+            cells = ''.join(f'<td{_random_attributes(rng)}>{_well_formed_markup(rng, level + 1)}</td>'
+                            for _ in range(rng.randint(1, 3)))
+            out.append(f'<table><tr{_random_attributes(rng)}>{cells}</tr></table>')
+        elif roll < 0.75:
+            items = ''.join(f'<li{_random_attributes(rng)}>{_well_formed_markup(rng, level + 1)}</li>'
+                            for _ in range(rng.randint(1, 3)))
+            out.append(f'<ul>{items}</ul>')
+        elif roll < 0.85:
+            out.append(f'<p{_random_attributes(rng)}>{_well_formed_markup(rng, level + 1, True)}</p>')
+        else:
+            tag = rng.choice(BLOCK_TAGS)
+            out.append(f'<{tag}{_random_attributes(rng)}>{_well_formed_markup(rng, level + 1)}</{tag}>')
+    return ''.join(out)
+
+
+def make_well_formed_document(rng):
+    return '<html><body>' + _well_formed_markup(rng, 0) + '</body></html>'
+
+
+def check_backends(documents):
+    # Returns the documents for which the bs4 and lxml backends differ; needs lxml.
+    return [html for html in documents
+            if ex.remove_invisible_and_extract_text(html, 'bs4') != ex.remove_invisible_and_extract_text(html, 'lxml')]
+
+
+def check_known_divergences():
+    # Returns the KNOWN_DIVERGENCES entries the backends no longer answer as recorded.
+    return [(description, html) for description, html, bs4_text, lxml_text in KNOWN_DIVERGENCES
+            if (ex.remove_invisible_and_extract_text(html, 'bs4'), ex.remove_invisible_and_extract_text(html, 'lxml'))
+            != (bs4_text, lxml_text)]
+
+
+# TIMING
+
+def _best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def available_backends():
+    backends = {'reference': reference_visible_text,
+                'bs4': lambda html: ex.remove_invisible_and_extract_text(html, 'bs4')}
+    try:
+        import lxml.html
+    except ImportError:
+        return backends
+    backends['lxml'] = lambda html: ex.remove_invisible_and_extract_text(html, 'lxml')
+    return backends
+
+
+def run_benchmark(documents=20, block_counts=(10, 40, 160), depth=8, repeat=3, seed=0):
+    backends = available_backends()
+    report = {'documents': documents, 'depth': depth, 'repeat': repeat, 'seed': seed, 'sizes': []}
+    for blocks in block_counts:
+        corpus = make_corpus(documents, blocks, depth, seed)
+        entry = {'blocks': blocks, 'html_bytes': sum(len(html) for html in corpus) // documents}
+        for name, extract in backends.items():
+            seconds = _best_time(lambda: [extract(html) for html in corpus], repeat)
+            entry[name] = seconds / documents
+        for name in backends:
+            if name != 'reference':
+                entry[f'{name}_speedup'] = entry['reference'] / entry[name] if entry[name] else None
+        report['sizes'].append(entry)
+    return report
+
+
+def print_report(report):
+    print(f"{report['documents']} newsletters per size, wrappers {report['depth']} deep, "
+          f"best of {report['repeat']}, time per document")
+    for entry in report['sizes']:
+        print("\n" + "=" * 60)
+        print(f"Blocks: {entry['blocks']} ({entry['html_bytes']:,} bytes of HTML)")
+        print("=" * 60)
+        for name, value in entry.items():
+            if name in ('blocks', 'html_bytes') or value is None:
+                continue
+            if name.endswith('speedup'):
+                print(f"  {name:<30} {value:>10,.2f}x")
+            else:
+                print(f"  {name:<30} {value * 1000:>10,.2f} ms")
+
+
+def benchmark_main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark visible-text extraction on synthetic newsletters.')
+    parser.add_argument('--documents', type=int, default=20, help='newsletters per size')
+    parser.add_argument('--blocks', default='10,40,160', help='content blocks per newsletter, one size per run')
+    parser.add_argument('--depth', type=int, default=8, help='layout wrappers around each block')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-documents', type=int, default=500,
+                        help='random documents compared with the reference, and across backends, before timing')
+    parser.add_argument('--json', help='also write the report to this path')
+    args = parser.parse_args(argv)
+
+    block_counts = [int(blocks) for blocks in args.blocks.split(',') if blocks]
+    rng = random.Random(args.seed)
+    documents = [make_random_document(rng) for _ in range(args.check_documents)]
+    documents += make_corpus(args.documents, block_counts[0], args.depth, args.seed)
+    mismatches = check_reference(documents)
+    if mismatches:
+        for html in mismatches[:5]:
+            print(f"REFERENCE MISMATCH on {html!r}")
+        print(f"{len(mismatches)} of {len(documents)} documents differ from the reference")
+        return 1
+    print(f"Reference: {len(documents)} documents identical")
+
+    if 'lxml' in available_backends():
+        documents = [make_well_formed_document(rng) for _ in range(args.check_documents)]
+        documents += make_corpus(args.documents, block_counts[0], args.depth, args.seed)
+        mismatches = check_backends(documents)
+        for html in mismatches[:5]:
+            print(f"BACKEND MISMATCH on {html!r}")
+        for description, html in check_known_divergences():
+            mismatches.append(html)
+            print(f"KNOWN DIVERGENCE CHANGED: {description}")
+        if mismatches:
+            return 1
+        print(f"Backends: {len(documents)} well-formed documents identical, "
+              f"{len(KNOWN_DIVERGENCES)} known divergences as recorded")
+
+    report = run_benchmark(args.documents, block_counts, args.depth, args.repeat, args.seed)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_main(sys.argv[1:]))
@@ -0,0 +1,339 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+import impersonation_analysis as ia
+
+# ORACLE CASES
+#
+# The demo cases from impersonation_analysis.__main__ with their expected results (non-zero
+# counters only). The benchmark refuses to report numbers when any of them changes.
+
+ORACLE_CASES = [
+    ("Microsoft",
+     "contact support-Microsoft support-Microsoft support-Micro<200c>soft Microsoft Microosoft Micr<200b>osoft support team for help",
+     {'raw_direct': 1, 'raw_typo': 1, 'raw_combo': 2, 'invisible_direct': 1, 'invisible_combo': 1}),
+    ("PayPal", "Paypal support-PayPal PayPaI support-Paypal Pay<200b>Pal",
+     {'raw_direct': 1, 'raw_typo': 1, 'raw_combo': 2, 'invisible_direct': 1}),
+    ("Harbor Freight", "𝐇𝐚𝐫𝐛𝐨𝐫 𝐅𝐫𝐞𝐢𝐠𝐡𝐭 Harbor Freight support",
+     {'raw_direct': 1, 'normalized_direct': 1}),
+    ("Costco", "C.O.S.T.C.O Latest News Need your Feedback To win",
+     {'special_direct': 1}),
+    ("Capital One", "Your Capital OneR document is ready. CapitalOne support Capital<200b>One",
+     {'raw_typo': 2, 'invisible_typo': 1}),
+    ("American Express", "American Expresss American Express supportAmericanExpress AmericanExpress American<200c>Express",
+     {'raw_direct': 1, 'raw_typo': 2, 'raw_combo': 1, 'invisible_typo': 1}),
+    ("Bank of America", "BankofAmerica Bank of America Bank<200b>of<200b>America Bankof America",
+     {'raw_direct': 1, 'raw_typo': 2, 'invisible_typo': 1}),
+    ("Wells Fargo", "Wells Fargo support WellsFargo Wells<200c>Fargo Wellss Fargo",
+     {'raw_direct': 1, 'raw_typo': 2, 'invisible_typo': 1}),
+    ("American Express", "𝐀𝐦𝐞𝐫𝐢𝐜𝐚𝐧 𝐄𝐱𝐩𝐫𝐞𝐬𝐬 card support",
+     {'normalized_direct': 1}),
+    ("Wells Fargo", "W.E.L.L.S F.A.R.G.O support team",
+     {'special_direct': 1}),
+    ("State Farm", "Stɑte Fɑrm insurance support",
+     {'normalized_direct': 1}),
+    ("PayPal", "Pаypal account verification",
+     {'raw_typo': 1}),
+]
+
+
+def check_oracle():
+    # Returns a list of (brand, text, expected, got) for every case that no longer matches,
+    # through both main() and BrandMatcher.
+    failures = []
+    matcher = ia.BrandMatcher([my_brand.lower() for my_brand, _, _ in ORACLE_CASES])
+    for my_brand, my_text, expected in ORACLE_CASES:
+        my_brand, my_text = my_brand.lower(), my_text.lower()
+        for result_box in (ia.main(my_brand, my_text), matcher.match(my_text)[my_brand]):
+            got = {k: v for k, v in result_box.items() if v}
+            if got != expected:
+                failures.append((my_brand, my_text, expected, got))
+    return failures
+
+
+# SYNTHETIC CORPUS
+
+SEED_BRANDS = [
+    "microsoft", "paypal", "costco", "amazon", "netflix", "apple", "docusign", "dropbox",
+    "capital one", "american express", "bank of america", "wells fargo", "harbor freight",
+    "state farm", "chase bank", "home depot",
+]
+
+FILLER_WORDS = [
+    "your", "account", "has", "been", "suspended", "please", "verify", "the", "information",
+    "below", "click", "here", "to", "continue", "we", "noticed", "unusual", "activity", "on",
+    "payment", "invoice", "attached", "document", "ready", "for", "review", "support", "team",
+    "security", "alert", "update", "details", "within", "24", "hours", "thank", "you", "customer",
+    "service", "login", "password", "expired", "confirm", "identity", "reward", "card", "order",
+]
+
+SYLLABLES = ["ka", "lo", "mi", "ta", "ven", "ro", "zu", "pex", "dra", "no", "qui", "sel", "bar", "tiv", "om"]
+
+ZERO_WIDTH_MARKERS = ["<200b>", "<200c>", "<200d>", "<feff>"]
+
+
+def _math_bold(text):
+    # MATHEMATICAL BOLD letters and digits, which NFKD folds back to ASCII.
+    out = []
+    for ch in text:
+        if 'a' <= ch <= 'z':
+            out.append(chr(0x1D41A + ord(ch) - ord('a')))
+        elif 'A' <= ch <= 'Z':
+            out.append(chr(0x1D400 + ord(ch) - ord('A')))
+        elif '0' <= ch <= '9':
+            out.append(chr(0x1D7CE + ord(ch) - ord('0')))
+        else:
+            out.append(ch)
+    return ''.join(out)
+
+
+HOMOGLYPHS = {'a': 'а', 'c': 'с', 'e': 'е', 'o': 'о', 'p': 'р', 'x': 'х', 'y': 'у', 'i': 'і'}
+
+
+def _homoglyph(rng, my_brand):
+    # Cyrillic look-alikes for some of the letters that have one.
+    return ''.join(HOMOGLYPHS[ch] if ch in HOMOGLYPHS and rng.random() < 0.5 else ch for ch in my_brand)
+
+
+def _zero_width(rng, my_brand):
+    position = rng.randint(1, max(1, len(my_brand) - 1))
+    return my_brand[:position] + rng.choice(ZERO_WIDTH_MARKERS) + my_brand[position:]
+
+
+def _dotted(rng, my_brand):
+    return ' '.join('.'.join(word) for word in my_brand.split())
+
+
+def _combo(rng, my_brand):
+    affix = rng.choice(["support", "secure", "login", "account", "team"])
+    joined = my_brand.replace(' ', '')
+    return rng.choice([f"{affix}-{joined}", f"{joined}{affix}", f"{affix}{joined}"])
+
+
+def _typo(rng, my_brand):
+    chars = list(my_brand)
+    position = rng.randrange(len(chars))
+    edit = rng.choice(['substitute', 'insert', 'delete', 'transpose'])
+    if edit == 'substitute':
+        chars[position] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+    elif edit == 'insert':
+        chars.insert(position, chars[position])
+    elif edit == 'delete' and len(chars) > 1:
+        del chars[position]
+    elif edit == 'transpose' and position + 1 < len(chars):
+        chars[position], chars[position + 1] = chars[position + 1], chars[position]
+    return ''.join(chars)
+
+
+VARIANTS = {
+    'direct': lambda rng, my_brand: my_brand,
+    'zero_width': _zero_width,
+    'math_bold': lambda rng, my_brand: _math_bold(my_brand),
+    'homoglyph': _homoglyph,
+    'dotted': _dotted,
+    'combo': _combo,
+    'typo': _typo,
+}
+
+
+def make_catalog(size, seed=0):
+    # SEED_BRANDS first, then made-up one- and two-word names.
+    rng = random.Random(seed)
+    catalog = list(SEED_BRANDS[:size])
+    seen = set(catalog)
+    while len(catalog) < size:
+        words = [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+                 for _ in range(rng.choice([1, 1, 2]))]
+        name = ' '.join(words)
+        if name not in seen:
+            seen.add(name)
+            catalog.append(name)
+    return catalog
+
+
+def make_message(rng, words, brands, injections):
+    tokens = [rng.choice(FILLER_WORDS) for _ in range(words)]
+    for _ in range(injections):
+        variant = rng.choice(list(VARIANTS))
+        tokens.insert(rng.randrange(len(tokens) + 1), VARIANTS[variant](rng, rng.choice(brands)))
+    return ' '.join(tokens)
+
+
+def make_corpus(count, words, brands, injections=3, seed=0):
+    rng = random.Random(seed)
+    return [make_message(rng, words, brands, injections) for _ in range(count)]
+
+
+# TIMING
+
+def clear_caches():
+    ia.segmentation_cache.clear()
+    ia.ascii_fold.cache_clear()
+
+
+def _best_time(fn, repeat, cold):
+    best = None
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_normalization(corpus, repeat, cold):
+    token_lists = [my_text.split() for my_text in corpus]
+    invisible = [ia.remove_unicode_text_patterns(tokens) for tokens in token_lists]
+    normalized = [ia.normalize_unicode_text(tokens) for tokens in invisible]
+    return {
+        'remove_unicode_text_patterns': _best_time(
+            lambda: [ia.remove_unicode_text_patterns(tokens) for tokens in token_lists], repeat, cold),
+        'normalize_unicode_text': _best_time(
+            lambda: [ia.normalize_unicode_text(tokens) for tokens in invisible], repeat, cold),
+        'remove_special_characters': _best_time(
+            lambda: [ia.remove_special_characters(tokens) for tokens in normalized], repeat, cold),
+        'token_views': _best_time(
+            lambda: [ia.TokenViews(tokens) for tokens in token_lists], repeat, cold),
+    }
+
+
+def bench_detection(corpus, brands, repeat, cold):
+    # Each detector over the full view of every stage, for every brand of its kind.
+    views = [ia.TokenViews(my_text.split()) for my_text in corpus]
+    one_word = [my_brand for my_brand in brands if len(my_brand.split()) == 1]
+    multi_word = [my_brand for my_brand in brands if len(my_brand.split()) > 1]
+
+    def run_oneword(prefix):
+        for view in views:
+            tokens, _ = view.stage_tokens(prefix)
+            for my_brand in one_word:
+                ia.process_detection_oneword(tokens, my_brand, ia._empty_result_box(), prefix)
+
+    def run_multiword(prefix):
+        for view in views:
+            tokens, _ = view.stage_tokens(prefix)
+            for my_brand in multi_word:
+                ia.process_detection_multiword(tokens, my_brand, len(my_brand.split()), ia._empty_result_box(), prefix)
+
+    timings = {}
+    for prefix in ia.STAGES:
+        timings[f'process_detection_oneword.{prefix.rstrip("_")}'] = _best_time(lambda: run_oneword(prefix), repeat, cold)
+        timings[f'process_detection_multiword.{prefix.rstrip("_")}'] = _best_time(lambda: run_multiword(prefix), repeat, cold)
+    return timings
+
+
+def bench_end_to_end(corpus, brands, repeat, cold):
+    matcher = ia.BrandMatcher(brands)
+
+    def run_main():
+        for my_text in corpus:
+            for my_brand in brands:
+                ia.main(my_brand, my_text)
+
+    def run_matcher():
+        for my_text in corpus:
+            matcher.match(my_text)
+
+    main_time = _best_time(run_main, repeat, cold)
+    matcher_time = _best_time(run_matcher, repeat, cold)
+    return {
+        'main': main_time,
+        'main_messages_per_sec': len(corpus) / main_time if main_time else None,
+        'brand_matcher': matcher_time,
+        'brand_matcher_messages_per_sec': len(corpus) / matcher_time if matcher_time else None,
+    }
+
+
+def measure_pruning(corpus, brands):
+    # How many token or window comparisons the length buckets skip, over one BrandMatcher pass.
+    matcher = ia.BrandMatcher(brands)
+    stats = ia.CascadeStats()
+    for my_text in corpus:
+        matcher.match(my_text, stats)
+    pairs = stats.pruned_pairs + stats.distance_calls
+    return {'distance_calls': stats.distance_calls, 'pruned_pairs': stats.pruned_pairs,
+            'pair_pruning_rate': stats.pruned_pairs / pairs if pairs else None}
+
+
+def run_benchmark(messages=100, words=80, catalog_sizes=(10, 50, 200), injections=3, repeat=3,
+                  cold=False, seed=0, skip_main_above=200):
+    # main() is called once per brand, so it is only timed for catalogs up to skip_main_above.
+    report = {'messages': messages, 'words': words, 'injections': injections, 'repeat': repeat,
+              'cold': cold, 'seed': seed, 'catalogs': []}
+    for size in catalog_sizes:
+        brands = make_catalog(size, seed)
+        corpus = make_corpus(messages, words, brands, injections, seed)
+        entry = {'catalog_size': size}
+        entry['normalization'] = bench_normalization(corpus, repeat, cold)
+        entry['pruning'] = measure_pruning(corpus, brands)
+        if size <= skip_main_above:
+            entry['detection'] = bench_detection(corpus, brands, repeat, cold)
+            entry['end_to_end'] = bench_end_to_end(corpus, brands, repeat, cold)
+        else:
+            matcher = ia.BrandMatcher(brands)
+            matcher_time = _best_time(lambda: [matcher.match(my_text) for my_text in corpus], repeat, cold)
+            entry['end_to_end'] = {'brand_matcher': matcher_time,
+                                   'brand_matcher_messages_per_sec': messages / matcher_time if matcher_time else None}
+        report['catalogs'].append(entry)
+    return report
+
+
+def print_report(report):
+    print(f"{report['messages']} messages x {report['words']} words, {report['injections']} injected variants "
+          f"each, best of {report['repeat']}{' (cold caches)' if report['cold'] else ''}")
+    for entry in report['catalogs']:
+        print("\n" + "=" * 60)
+        print(f"Catalog size: {entry['catalog_size']}")
+        print("=" * 60)
+        for section in ('normalization', 'detection', 'end_to_end', 'pruning'):
+            for name, value in entry.get(section, {}).items():
+                if value is None:
+                    continue
+                if name.endswith('_rate'):
+                    print(f"  {name:<45} {value:>12.1%}")
+                elif section == 'pruning':
+                    print(f"  {name:<45} {value:>12,}")
+                elif name.endswith('per_sec'):
+                    print(f"  {name:<45} {value:>12,.1f}")
+                else:
+                    print(f"  {name:<45} {value * 1000:>10,.2f} ms")
+
+
+def benchmark_main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the brand impersonation detector.')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--words', type=int, default=80, help='filler words per message')
+    parser.add_argument('--catalog-sizes', default='10,50,200')
+    parser.add_argument('--injections', type=int, default=3, help='brand variants injected per message')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cold', action='store_true', help='clear the segmentation and folding caches before each run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the report to this path')
+    parser.add_argument('--skip-main-above', type=int, default=200,
+                        help='only time the BrandMatcher for larger catalogs')
+    args = parser.parse_args(argv)
+
+    failures = check_oracle()
+    if failures:
+        for my_brand, my_text, expected, got in failures:
+            print(f"ORACLE MISMATCH {my_brand!r} on {my_text!r}: expected {expected}, got {got}")
+        return 1
+    print(f"Oracle: {len(ORACLE_CASES)} cases OK")
+
+    catalog_sizes = [int(size) for size in args.catalog_sizes.split(',') if size]
+    report = run_benchmark(args.messages, args.words, catalog_sizes, args.injections, args.repeat,
+                           args.cold, args.seed, args.skip_main_above)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark_main(sys.argv[1:]))
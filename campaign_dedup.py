@@ -0,0 +1,215 @@
+import argparse
+import json
+import random
+import re
+import sys
+import zlib
+
+import extract_contents_forwarded_as_attachements as extraction
+from impersonation_analysis import BrandMatcher, load_brands, load_compiled_catalog
+
+# CAMPAIGN DEDUPLICATION
+#
+# Messages of one campaign differ only in names, links and tracking numbers. Each message
+# gets a MinHash signature over word shingles of its visible text; an LSH index over the
+# signatures finds earlier messages that are probably near-duplicates. The first message of
+# a cluster is its representative: only representatives go through brand matching and the
+# LLM, and every member is written with the representative's results and the cluster ID.
+
+NUM_PERM = 128
+LSH_BANDS = 16
+SHINGLE_SIZE = 5
+SIMILARITY_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+_DIGITS_RE = re.compile(r'\d+')
+_WORD_RE = re.compile(r'\w+')
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    # Word shingles of the text with links and numbers masked, so per-recipient tracking
+    # links and order numbers do not split a campaign.
+    text = _DIGITS_RE.sub('0', _URL_RE.sub(' url ', text.lower()))
+    words = _WORD_RE.findall(text)
+    if len(words) < size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_PERM, seed=1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.permutations = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+
+    def signature(self, text):
+        # None for text without any word; such messages are never clustered.
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)]
+        if not hashes:
+            return None
+        return tuple(min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+                     for a, b in self.permutations)
+
+
+def estimate_similarity(signature_a, signature_b):
+    # The fraction of equal MinHash values estimates the Jaccard similarity of the shingles.
+    return sum(x == y for x, y in zip(signature_a, signature_b)) / len(signature_a)
+
+
+class CampaignIndex:
+    # Leader clustering over an LSH index of the representatives' signatures: a message joins
+    # the most similar cluster whose representative shares at least one LSH band with it and
+    # reaches the threshold, or starts a new cluster. Clusters are decided as messages arrive,
+    # so the corpus is processed in one pass.
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, num_perm=NUM_PERM, bands=LSH_BANDS, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, seed)
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+        self.sizes = {}
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows] for band in range(self.bands)]
+
+    def assign(self, key, text):
+        # Returns (cluster_id, is_representative, similarity to the representative).
+        signature = self.hasher.signature(text)
+        if signature is None:
+            self.sizes[key] = 1
+            return key, True, 1.0
+
+        band_keys = self._band_keys(signature)
+        candidates = set()
+        for buckets, band_key in zip(self.buckets, band_keys):
+            candidates.update(buckets.get(band_key, ()))
+
+        best_cluster, best_similarity = None, 0.0
+        for cluster_id in candidates:
+            similarity = estimate_similarity(signature, self.signatures[cluster_id])
+            if similarity > best_similarity:
+                best_cluster, best_similarity = cluster_id, similarity
+        if best_cluster is not None and best_similarity >= self.threshold:
+            self.sizes[best_cluster] += 1
+            return best_cluster, False, best_similarity
+
+        self.signatures[key] = signature
+        self.sizes[key] = 1
+        for buckets, band_key in zip(self.buckets, band_keys):
+            buckets.setdefault(band_key, []).append(key)
+        return key, True, 1.0
+
+    def stats(self):
+        messages = sum(self.sizes.values())
+        return {
+            'messages': messages,
+            'clusters': len(self.sizes),
+            'largest_cluster': max(self.sizes.values(), default=0),
+            'dedup_ratio': messages / len(self.sizes) if self.sizes else 0.0,
+        }
+
+
+def dedup_analyze(source, output_path, brands, extension='.eml', llm=False, cache=None, workers=None,
+                  max_in_flight=None, timeout=None, backend='bs4', threshold=SIMILARITY_THRESHOLD,
+                  lowercase=True, max_body_tokens=None, text_cache_path=None, catalog_path=None):
+    # Extracts every message (the signature needs the visible text), then runs the brand
+    # cascade and, with llm=True, analyze_email once per cluster. Writes one JSONL record per
+    # message: message_id, error, cluster_id, representative, similarity, impersonation and,
+    # with llm=True, llm_response and label. With catalog_path, brands is ignored and the
+    # compiled catalog (and its lowercase setting) is used.
+    if llm:
+        # Imported here so deduplicated brand matching works without openai/tiktoken.
+        import prompt_example
+
+    text_cache = since = None
+    if text_cache_path is not None:
+        text_cache = extraction.VisibleTextCache(text_cache_path)
+        since = text_cache.shared_counts()
+
+    index = CampaignIndex(threshold)
+    if catalog_path is not None:
+        matcher, header = load_compiled_catalog(catalog_path)
+        lowercase = header['lowercase']
+    else:
+        matcher = BrandMatcher([my_brand.lower() for my_brand in brands] if lowercase else list(brands))
+    cluster_results = {}
+    llm_calls = 0
+
+    items = extraction.iter_extraction_items(source, extension)
+    with open(output_path, 'w', encoding='utf-8') as out:
+        for key, content, error in extraction.extract_parallel(items, workers, max_in_flight, timeout=timeout,
+                                                               backend=backend, text_cache_path=text_cache_path):
+            record = {'message_id': key, 'error': error}
+            if content is not None:
+                cluster_id, is_representative, similarity = index.assign(key, content)
+                if is_representative:
+                    results = matcher.match(content.lower() if lowercase else content)
+                    analysis = {'impersonation': {my_brand: result_box for my_brand, result_box in results.items()
+                                                  if any(result_box.values())}}
+                    if llm:
+                        response_text = prompt_example.analyze_email(content, cache=cache,
+                                                                     max_body_tokens=max_body_tokens)
+                        analysis['llm_response'] = response_text
+                        analysis['label'] = prompt_example.parse_label(response_text)
+                        llm_calls += 1
+                    cluster_results[cluster_id] = analysis
+                record.update({'cluster_id': cluster_id, 'representative': is_representative,
+                               'similarity': round(similarity, 4)})
+                record.update(cluster_results[cluster_id])
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    stats = index.stats()
+    stats['llm_calls'] = llm_calls
+    if text_cache is not None:
+        stats['text_cache'] = text_cache.shared_stats(since)
+        text_cache.close()
+    return stats
+
+
+def dedup_main(argv):
+    parser = argparse.ArgumentParser(description='Cluster near-duplicate emails and analyze one message per cluster.')
+    parser.add_argument('source', help='.eml file, directory of .eml files, maildir or mbox file')
+    parser.add_argument('-o', '--output', required=True, help='JSONL output path')
+    catalog = parser.add_mutually_exclusive_group(required=True)
+    catalog.add_argument('--brands', help='brand CSV: a "brand" column, or one brand per line')
+    catalog.add_argument('--catalog', help='compiled brand catalog, see impersonation_analysis.py')
+    parser.add_argument('--extension', default='.eml')
+    parser.add_argument('--llm', action='store_true', help='also run analyze_email on every representative')
+    parser.add_argument('--cache', help='SQLite response cache path')
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD,
+                        help='estimated Jaccard similarity needed to join a cluster')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None, help='per-file extraction timeout in seconds')
+    parser.add_argument('--backend', choices=sorted(extraction.TEXT_BACKENDS), default='bs4')
+    parser.add_argument('--case-sensitive', action='store_true')
+    parser.add_argument('--max-body-tokens', type=int, default=None)
+    parser.add_argument('--text-cache', help='SQLite visible-text cache path, shared by the workers')
+    args = parser.parse_args(argv)
+
+    brands = list(load_brands(args.brands).values()) if args.brands else None
+    cache = None
+    if args.cache:
+        import prompt_example
+        cache = prompt_example.ResponseCache(args.cache)
+    try:
+        stats = dedup_analyze(args.source, args.output, brands, extension=args.extension,
+                              llm=args.llm, cache=cache, workers=args.workers, max_in_flight=args.max_in_flight,
+                              timeout=args.timeout, backend=args.backend, threshold=args.threshold,
+                              lowercase=not args.case_sensitive, max_body_tokens=args.max_body_tokens,
+                              text_cache_path=args.text_cache, catalog_path=args.catalog)
+    finally:
+        if cache is not None:
+            cache.close()
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    dedup_main(sys.argv[1:])
@@ -1,153 +1,843 @@
 import os
 import mailparser
 import re
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 import html2text
 import base64
+import email.parser
+import hashlib
+import mailbox
+import multiprocessing.util
+import sqlite3
+import sys
+import json
+import signal
+import argparse
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from metrics import CounterStats, write_prometheus
+
+# html2text options used for every body. HTML2Text keeps per-document parser state (open
+# tags, link lists, output buffer), so a converter is made per document from these options.
+HTML2TEXT_OPTIONS = {
+    'ignore_links': True,
+    'ignore_images': True,
+    'body_width': 0,
+}
+
+def make_text_converter(options=HTML2TEXT_OPTIONS):
+    h = html2text.HTML2Text()
+    for name, value in options.items():
+        setattr(h, name, value)
+    return h
+
+_SIZED_FONT_RE = re.compile(r'font-size:\s*[1-9]')
+_CSS_DISPLAY_NONE_RE = re.compile(r'\.([^\s{]+)\s*{[^}]*display\s*:\s*none', re.IGNORECASE)
+_CSS_VISIBILITY_HIDDEN_RE = re.compile(r'\.([^\s{]+)\s*{[^}]*visibility\s*:\s*hidden', re.IGNORECASE)
+
+def invisible_style_reason(style):
+    # Reason an inline style hides its element, or None. 'font-size:0' only hides the
+    # element when no descendant sets a non-zero font size again.
+    style = str(style).lower().replace(' ', '')
+    
+    if 'display:none' in style:
+        return 'display:none'
+    if 'visibility:hidden' in style:
+        return 'visibility:hidden'
+    
+    if 'width:0' in style and 'height:0' in style:
+        return 'width:0_height:0'
+    
+    if 'font-size:0' in style:
+        return 'font-size:0'
+    
+    return None
 
 def is_truly_invisible(tag):
     if not tag or not hasattr(tag, 'get'):
         return False, None
     
     try:
-        style = str(tag.get('style', '')).lower().replace(' ', '')
-        
-        if 'display:none' in style:
-            return True, 'display:none'
-        if 'visibility:hidden' in style:
-            return True, 'visibility:hidden'
+        reason = invisible_style_reason(tag.get('style', ''))
         
-        if 'width:0' in style and 'height:0' in style:
-            return True, 'width:0_height:0'
-        
-        if 'font-size:0' in style:
+        if reason == 'font-size:0':
             try:
                 all_descendants = tag.find_all(style=True)
                 for desc in all_descendants:
                     desc_style = str(desc.get('style', '')).lower()
-                    if re.search(r'font-size:\s*[1-9]', desc_style):
+                    if _SIZED_FONT_RE.search(desc_style):
                         return False, None
             except:
                 pass
-            return True, 'font-size:0'
         
+        if reason:
+            return True, reason
         return False, None
     except:
         return False, None
 
-def remove_invisible_and_extract_text(html_content):
-    try:
-        if not html_content:
-            return ''
+def hidden_css_classes(style_content):
+    hidden_classes = {}
+    style_lower = style_content.lower()
+    
+    for match in _CSS_DISPLAY_NONE_RE.findall(style_lower):
+        if match:
+            hidden_classes[match] = 'css_display:none'
+    
+    for match in _CSS_VISIBILITY_HIDDEN_RE.findall(style_lower):
+        if match:
+            hidden_classes[match] = 'css_visibility:hidden'
+    
+    return hidden_classes
+
+class Bs4Tree:
+    # How prune_invisible reads and edits a BeautifulSoup tree.
+    @staticmethod
+    def children(tag):
+        return [child for child in tag.contents if isinstance(child, Tag)]
+    
+    @staticmethod
+    def attrs(tag):
+        return tag.attrs
+    
+    @staticmethod
+    def is_style_tag(tag):
+        return tag.name == 'style'
+    
+    @staticmethod
+    def classes(tag):
+        classes = tag.attrs.get('class') or []
+        if isinstance(classes, str):
+            classes = [classes]
+        return classes
+    
+    @staticmethod
+    def style_text(tag):
+        return tag.get_text()
+    
+    @staticmethod
+    def remove(tag):
+        tag.decompose()
+    
+    @staticmethod
+    def is_removed(tag):
+        return tag.decomposed
+
+class LxmlTree:
+    # How prune_invisible reads and edits an lxml.html tree. drop_tree() keeps the element's
+    # tail text, and a dropped subtree is merely detached, so removing inside it is harmless.
+    @staticmethod
+    def children(element):
+        return [child for child in element if isinstance(child.tag, str)]
+    
+    @staticmethod
+    def attrs(element):
+        return element.attrib
+    
+    @staticmethod
+    def is_style_tag(element):
+        return element.tag == 'style'
+    
+    @staticmethod
+    def classes(element):
+        return element.get('class', '').split()
+    
+    @staticmethod
+    def style_text(element):
+        return element.text or ''
+    
+    @staticmethod
+    def remove(element):
+        element.drop_tree()
+    
+    @staticmethod
+    def is_removed(element):
+        return False
+
+class _SizedFontIndex:
+    # Answers "does any descendant set a non-zero font size?" for font-size:0 elements.
+    # Subtrees under a [hidden] element do not count, since those are removed first.
+    # Each element is evaluated at most once, so the checks are linear over the document
+    # instead of one find_all per font-size:0 element. The memo holds on to each element, as
+    # lxml proxies that were garbage collected could otherwise hand their id() to another.
+    def __init__(self, tree):
+        self.tree = tree
+        self.memo = {}
+    
+    def has_sized_descendant(self, tag):
+        tree = self.tree
+        memo = self.memo
+        if id(tag) in memo:
+            return memo[id(tag)][1]
         
-        soup = BeautifulSoup(html_content, 'html.parser')
+        # Iterative post-order, so deeply nested markup cannot hit the recursion limit.
+        stack = [(tag, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in memo:
+                continue
+            children = tree.children(node)
+            if not children_done:
+                stack.append((node, True))
+                for child in children:
+                    if id(child) not in memo and 'hidden' not in tree.attrs(child):
+                        stack.append((child, False))
+                continue
+            
+            sized = False
+            for child in children:
+                attrs = tree.attrs(child)
+                if 'hidden' in attrs:
+                    continue
+                if 'style' in attrs and _SIZED_FONT_RE.search(str(attrs['style']).lower()):
+                    sized = True
+                    break
+                if memo[id(child)][1]:
+                    sized = True
+                    break
+            memo[id(node)] = (node, sized)
+        return memo[id(tag)][1]
+
+def prune_invisible(root, tree=Bs4Tree, stats=None):
+    # One top-down pass: a [hidden] element or an element with an invisible inline style is
+    # dropped with its whole subtree, which is then never visited. The pass also collects
+    # the surviving <style> tags and class-bearing elements, so hidden CSS classes can be
+    # applied without searching the tree again.
+    sized_fonts = _SizedFontIndex(tree)
+    removed = []
+    style_tags = []
+    classed = []
+    
+    stack = tree.children(root)[::-1]
+    while stack:
+        tag = stack.pop()
+        attrs = tree.attrs(tag)
         
-        # Remove hidden tags
-        hidden_tags = soup.find_all(attrs={'hidden': True})
-        for tag in hidden_tags:
-            if tag and hasattr(tag, 'decompose'):
-                try:
-                    tag.decompose()
-                except:
-                    pass
+        if 'hidden' in attrs:
+            removed.append(tag)
+            continue
         
-        # Remove invisible styled tags
-        tags_with_style = soup.find_all(style=True)
-        for tag in tags_with_style:
-            try:
-                is_invisible, method = is_truly_invisible(tag)
-                if is_invisible:
-                    tag.decompose()
-            except:
-                pass
+        if 'style' in attrs:
+            reason = invisible_style_reason(attrs['style'])
+            if reason and (reason != 'font-size:0' or not sized_fonts.has_sized_descendant(tag)):
+                removed.append(tag)
+                continue
         
-        # Remove CSS hidden classes
-        style_tags = soup.find_all('style')
-        hidden_classes = {}
+        if tree.is_style_tag(tag):
+            style_tags.append(tag)
+        if attrs.get('class'):
+            classed.append(tag)
         
-        for style_tag in style_tags:
-            if not style_tag:
-                continue
-            
-            try:
-                style_content = style_tag.get_text()
-            except:
-                style_content = None
-            
-            if style_content:
-                style_lower = style_content.lower()
-                
-                try:
-                    matches = re.findall(r'\.([^\s{]+)\s*{[^}]*display\s*:\s*none', 
-                                       style_lower, re.IGNORECASE)
-                    for match in matches:
-                        if match:
-                            hidden_classes[match] = 'css_display:none'
-                except:
-                    pass
-                
-                try:
-                    matches = re.findall(r'\.([^\s{]+)\s*{[^}]*visibility\s*:\s*hidden', 
-                                       style_lower, re.IGNORECASE)
-                    for match in matches:
-                        if match:
-                            hidden_classes[match] = 'css_visibility:hidden'
-                except:
-                    pass
-        
-        for class_name in hidden_classes.keys():
-            if not class_name:
+        stack.extend(tree.children(tag)[::-1])
+    
+    for tag in removed:
+        tree.remove(tag)
+    if stats is not None:
+        stats.removed_elements['inline'] += len(removed)
+    
+    hidden_classes = {}
+    for style_tag in style_tags:
+        style_content = tree.style_text(style_tag)
+        if style_content:
+            hidden_classes.update(hidden_css_classes(style_content))
+    
+    if hidden_classes:
+        for tag in classed:
+            if tree.is_removed(tag):
                 continue
-            
-            try:
-                for element in soup.find_all(class_=class_name):
-                    if element:
-                        element.decompose()
-            except:
-                pass
+            if any(class_name in hidden_classes for class_name in tree.classes(tag)):
+                tree.remove(tag)
+                if stats is not None:
+                    stats.removed_elements['css_class'] += 1
+    
+    return root
+
+# TEXT BACKENDS
+
+_MARKUP_CHARS_RE = re.compile(r'([&<>])')
+_MARKUP_ENTITIES = {'&': 'amp', '<': 'lt', '>': 'gt'}
+
+def _feed_text(h, text):
+    # Hands text to html2text in the same chunks its own parser would produce from a
+    # serialized tree: markup characters arrive as entity references, everything else as
+    # runs of data.
+    for chunk in _MARKUP_CHARS_RE.split(text):
+        if chunk in _MARKUP_ENTITIES:
+            h.handle_entityref(_MARKUP_ENTITIES[chunk])
+        elif chunk:
+            h.handle_data(chunk)
+
+def _finish_text(h):
+    # The tail of HTML2Text.handle(), for converters fed by events instead of a string.
+    markdown = h.optwrap(h.finish())
+    if h.pad_tables:
+        markdown = html2text.utils.pad_tables_in_text(markdown)
+    return markdown
+
+def _lxml_to_text(root, h):
+    from lxml.html import defs
+    
+    h.start = True
+    # Each entry is (element, entered); tails are fed after the element is closed.
+    stack = [(root, False)]
+    while stack:
+        element, entered = stack.pop()
+        tag = element.tag
+        if not isinstance(tag, str):
+            # Comments and processing instructions: only their tail is text.
+            if element.tail:
+                _feed_text(h, element.tail)
+            continue
         
-        # Convert to text
-        h = html2text.HTML2Text()
-        h.ignore_links = True
-        h.ignore_images = True
-        h.body_width = 0
+        if entered:
+            h.handle_endtag(tag)
+            if element.tail and element is not root:
+                _feed_text(h, element.tail)
+            continue
+        
+        h.handle_starttag(tag, list(element.attrib.items()))
+        if tag in defs.empty_tags:
+            h.handle_endtag(tag)
+            if element.tail and element is not root:
+                _feed_text(h, element.tail)
+            continue
+        
+        if element.text:
+            if tag in ('script', 'style'):
+                h.handle_data(element.text)
+            else:
+                _feed_text(h, element.text)
+        stack.append((element, True))
+        stack.extend((child, False) for child in reversed(element))
+    
+    return _finish_text(h)
+
+def _visible_text_bs4(html_content, stats=None):
+    # Reference implementation: prune the soup, serialize it, and let html2text parse it again.
+    started = time.perf_counter() if stats is not None else None
+    soup = BeautifulSoup(html_content, 'html.parser')
+    started = _phase_done(stats, 'parse', started)
+    
+    prune_invisible(soup, stats=stats)
+    started = _phase_done(stats, 'prune', started)
+    
+    # Convert to text
+    h = make_text_converter()
+    
+    text = h.handle(str(soup))
+    _phase_done(stats, 'text', started)
+    return text
+
+def _visible_text_lxml(html_content, stats=None):
+    # One lxml parse; pruning and text extraction both work on that tree, and html2text is
+    # driven by tree events, so nothing is serialized or parsed a second time. The text is
+    # the bs4 backend's on well-formed markup; on markup the parsers repair differently
+    # (unclosed <td>, <li>, <p>, nested <a>) see benchmark_extraction.KNOWN_DIVERGENCES.
+    import lxml.html
+    
+    started = time.perf_counter() if stats is not None else None
+    parser = lxml.html.HTMLParser(encoding='utf-8')
+    root = lxml.html.document_fromstring(html_content.encode('utf-8', errors='ignore'), parser=parser)
+    started = _phase_done(stats, 'parse', started)
+    
+    prune_invisible(root, LxmlTree, stats)
+    started = _phase_done(stats, 'prune', started)
+    
+    text = _lxml_to_text(root, make_text_converter())
+    _phase_done(stats, 'text', started)
+    return text
+
+TEXT_BACKENDS = {
+    'bs4': _visible_text_bs4,
+    'lxml': _visible_text_lxml,
+}
+
+def remove_invisible_and_extract_text(html_content, backend='bs4', stats=None, cache=None):
+    if backend not in TEXT_BACKENDS:
+        raise ValueError(f"Unknown HTML backend: {backend}")
+    
+    if stats is not None:
+        stats.record_call(backend, html_content)
+    try:
+        if not html_content:
+            return ''
         
-        text = h.handle(str(soup))
+        text = None
+        if cache is not None:
+            key, html_bytes = cache.make_key(html_content, backend)
+            text = cache.get(key)
+        if text is None:
+            text = TEXT_BACKENDS[backend](html_content, stats)
+            if cache is not None:
+                cache.put(key, text, html_bytes)
+        if stats is not None:
+            stats.text_chars += len(text)
         return text
         
+    except ImportError:
+        raise
     except Exception as e:
+        if stats is not None:
+            stats.errors += 1
+        return ''
+
+# VISIBLE TEXT CACHE
+
+# Bump when a change to the pruning or text code alters the extracted text without
+# changing any of the rules hashed in text_rules_version().
+EXTRACTION_RULES_REVISION = 1
+
+# A process writes its hit counts to the SQLite tier after this many lookups, and on close.
+COUNTER_FLUSH_INTERVAL = 256
+
+def text_rules_version():
+    # Cached texts are only reused while the invisibility rules and html2text options they
+    # were extracted with are unchanged.
+    payload = json.dumps([EXTRACTION_RULES_REVISION, HTML2TEXT_OPTIONS, _SIZED_FONT_RE.pattern,
+                          _CSS_DISPLAY_NONE_RE.pattern, _CSS_VISIBILITY_HIDDEN_RE.pattern], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _cache_stats(counts):
+    hits = counts['memory_hits'] + counts['disk_hits']
+    lookups = hits + counts['misses']
+    return dict(counts, hits=hits, hit_ratio=hits / lookups if lookups else 0.0)
+
+class VisibleTextCache:
+    # Visible text of HTML bodies keyed by a hash of (rules version, backend, HTML): campaign
+    # templates repeat one body byte for byte, so each is parsed once. The memory tier is a
+    # per-process LRU. With a path, a SQLite tier behind it is shared by every process that
+    # opens the file, and shared_stats() adds up the hit counts of all of them. bytes_saved
+    # is the size of the HTML that hits did not have to parse.
+    COUNTERS = ('memory_hits', 'disk_hits', 'misses', 'bytes_saved')
+    
+    def __init__(self, path=None, maxsize=10_000, max_entries=1_000_000):
+        self.path = path
+        self.maxsize = maxsize
+        self.max_entries = max_entries
+        self.rules_version = text_rules_version()
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self._unflushed = dict.fromkeys(self.COUNTERS, 0)
+        self._unflushed_lookups = 0
+        self._entries = OrderedDict()
+        self._conn = None
+        self._conn_pid = None
+        # SQLite errors (e.g. "database is locked") that were treated as a miss or a skipped write.
+        self.disk_errors = 0
+    
+    def _connection(self):
+        # One connection per process: a connection inherited through fork is never used. The
+        # connection is only kept once its schema is set up.
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+                    "CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                    "html_bytes INTEGER NOT NULL);"
+                    "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);"
+                )
+                # Entries of other rules can never be hit again.
+                row = conn.execute("SELECT value FROM meta WHERE key = 'rules_version'").fetchone()
+                if row is None or row[0] != self.rules_version:
+                    conn.execute("DELETE FROM texts")
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rules_version', ?)",
+                                 (self.rules_version,))
+                conn.commit()
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    def _rollback(self):
+        try:
+            if self._conn is not None:
+                self._conn.rollback()
+        except sqlite3.Error:
+            pass
+    
+    def make_key(self, html_content, backend):
+        # Returns (key, size of the HTML in bytes).
+        data = html_content.encode('utf-8', errors='surrogatepass')
+        digest = hashlib.sha256(f'{self.rules_version}:{backend}:'.encode('utf-8'))
+        digest.update(data)
+        return digest.hexdigest(), len(data)
+    
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def _count(self, name, html_bytes=0):
+        for counts in (self.counts, self._unflushed):
+            counts[name] += 1
+            counts['bytes_saved'] += html_bytes
+        self._unflushed_lookups += 1
+        if self.path is not None and self._unflushed_lookups >= COUNTER_FLUSH_INTERVAL:
+            self.flush()
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self._count('memory_hits', entry[1])
+            return entry[0]
+        if self.path is not None:
+            try:
+                row = self._connection().execute("SELECT text, html_bytes FROM texts WHERE key = ?",
+                                                 (key,)).fetchone()
+            except sqlite3.Error:
+                # A locked or broken file is a miss, never a failed extraction.
+                self.disk_errors += 1
+                row = None
+            if row is not None:
+                self._remember(key, row)
+                self._count('disk_hits', row[1])
+                return row[0]
+        self._count('misses')
+        return None
+    
+    def put(self, key, text, html_bytes):
+        self._remember(key, (text, html_bytes))
+        if self.path is None:
+            return
+        try:
+            conn = self._connection()
+            conn.execute("INSERT OR IGNORE INTO texts (key, text, html_bytes) VALUES (?, ?, ?)",
+                         (key, text, html_bytes))
+            # Oldest entries first; rowids only grow.
+            conn.execute("DELETE FROM texts WHERE rowid <= (SELECT MAX(rowid) FROM texts) - ?", (self.max_entries,))
+            conn.commit()
+        except sqlite3.Error:
+            # The text stays in the memory tier; only the shared write is skipped.
+            self.disk_errors += 1
+            self._rollback()
+    
+    def flush(self):
+        if self.path is None or not any(self._unflushed.values()):
+            return
+        # Reset first, so a failing file is retried at the next interval, not at every lookup.
+        self._unflushed_lookups = 0
+        try:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                list(self._unflushed.items())
+            )
+            conn.commit()
+        except sqlite3.Error:
+            # Kept for the next flush.
+            self.disk_errors += 1
+            self._rollback()
+            return
+        self._unflushed = dict.fromkeys(self.COUNTERS, 0)
+    
+    def stats(self):
+        # This process's lookups only.
+        return dict(_cache_stats(self.counts), size=len(self._entries), maxsize=self.maxsize,
+                    disk_errors=self.disk_errors)
+    
+    def shared_counts(self):
+        # The counters of every process that used the SQLite file so far, this one included.
+        self.flush()
+        counts = dict.fromkeys(self.COUNTERS, 0)
+        counts.update(self._connection().execute("SELECT name, value FROM counters"))
+        return counts
+    
+    def shared_stats(self, since=None):
+        # since, if given, is an earlier shared_counts(); only the lookups after it count.
+        counts = self.shared_counts()
+        if since is not None:
+            counts = {name: value - since[name] for name, value in counts.items()}
+        entries = self._connection().execute("SELECT COUNT(*) FROM texts").fetchone()[0]
+        return dict(_cache_stats(counts), entries=entries)
+    
+    def close(self):
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self.flush()
+            self._conn.close()
+        self._conn = None
+
+# INSTRUMENTATION
+
+EXTRACTION_PHASES = ('parse', 'prune', 'text')
+
+class ExtractionStats(CounterStats):
+    # Counters for remove_invisible_and_extract_text(..., stats=...). Without one, extraction
+    # only pays for a few "is None" checks. on_phase, if given, is called as
+    # on_phase(phase, seconds) after every phase.
+    NAMESPACE = 'extraction'
+    CALLBACKS = ('on_phase',)
+    METRICS = (
+        ('calls', 'calls_total', 'remove_invisible_and_extract_text calls.'),
+        ('empty_inputs', 'empty_inputs_total', 'Calls with no HTML.'),
+        ('errors', 'errors_total', 'Calls that failed and returned no text.'),
+        ('html_chars', 'html_chars_total', 'HTML characters read.'),
+        ('text_chars', 'text_chars_total', 'Visible text characters produced.'),
+        ('backend_calls', 'backend_calls_total', 'Calls per HTML backend.', 'backend'),
+        ('phase_seconds', 'phase_seconds_total', 'Wall time per extraction phase.', 'phase'),
+        ('removed_elements', 'removed_elements_total', 'Invisible elements removed.', 'reason'),
+    )
+    
+    def __init__(self, on_phase=None):
+        self.on_phase = on_phase
+        self.calls = 0
+        self.empty_inputs = 0
+        self.errors = 0
+        self.html_chars = 0
+        self.text_chars = 0
+        self.backend_calls = {name: 0 for name in TEXT_BACKENDS}
+        self.phase_seconds = dict.fromkeys(EXTRACTION_PHASES, 0.0)
+        # 'inline': hidden attribute or invisible inline style; 'css_class': hidden by a <style> rule.
+        self.removed_elements = {'inline': 0, 'css_class': 0}
+    
+    def record_call(self, backend, html_content):
+        self.calls += 1
+        self.backend_calls[backend] += 1
+        if html_content:
+            self.html_chars += len(html_content)
+        else:
+            self.empty_inputs += 1
+    
+    def record_phase(self, phase, seconds):
+        self.phase_seconds[phase] += seconds
+        if self.on_phase is not None:
+            self.on_phase(phase, seconds)
+
+def _phase_done(stats, phase, started):
+    # Records the phase that began at started and returns the start of the next one.
+    if stats is None:
+        return None
+    now = time.perf_counter()
+    stats.record_phase(phase, now - started)
+    return now
+
+# LAZY MIME WALKER
+#
+# mailparser decodes every part, attachments included, before the subject and the first
+# HTML part can be read. The walker finds the part boundaries in the raw bytes instead: it
+# parses part headers, decodes a payload only when it is body text, walks message/rfc822
+# parts (forwarded as attachment) in place, and stops at the first HTML part. Body parts
+# come in mailparser's order and are classified and decoded the way mailparser does it;
+# a message with a structure the walker does not handle is given to mailparser whole.
+
+_HEADER_FIELD_RE = re.compile(rb'[!-9;-~]+:')
+_BASE64_LINE_RE = re.compile(rb'[A-Za-z0-9+/]+={0,2}(?:\r?\n|\Z)')
+_BLANK_LINE_RE = re.compile(rb'\r?\n\r?\n')
+
+_header_parser = email.parser.BytesHeaderParser()
+_part_parser = email.parser.BytesParser()
+
+class _IrregularMessage(Exception):
+    pass
+
+def _split_headers(raw, start, end, default_type):
+    # Returns (headers, body_start) of the message or part in raw[start:end].
+    match = _BLANK_LINE_RE.search(raw, start, end)
+    header_end, body_start = (match.start(), match.end()) if match else (end, end)
+    headers = _header_parser.parsebytes(raw[start:header_end])
+    if headers.get_payload() or headers.defects:
+        raise _IrregularMessage()
+    headers.set_default_type(default_type)
+    return headers, body_start
+
+def _multipart_bounds(raw, start, end, boundary):
+    # (start, end) of every part of the multipart body in raw[start:end]. Like the email
+    # package, the line break before a boundary line is not part of the part.
+    try:
+        delimiter = re.compile(rb'^--' + re.escape(boundary.encode('ascii', 'surrogateescape')) + rb'(--)?[ \t]*\r?$',
+                               re.MULTILINE)
+    except UnicodeError:
+        raise _IrregularMessage() from None
+    bounds = []
+    part_start = None
+    for match in delimiter.finditer(raw, start, end):
+        if part_start is not None:
+            part_end = match.start()
+            part_end -= 2 if raw.startswith(b'\r\n', part_end - 2) else 1 if raw.startswith(b'\n', part_end - 1) else 0
+            bounds.append((part_start, max(part_end, part_start)))
+        if match.group(1):
+            return bounds
+        part_start = match.end() + (2 if raw.startswith(b'\r\n', match.end()) else 1)
+    raise _IrregularMessage()
+
+def _blocks_inline(headers):
+    disposition = headers.get_content_disposition()
+    return disposition not in (None, 'inline') or (disposition != 'inline' and bool(headers.get_filename()))
+
+def _is_body_part(headers, inside_attachment):
+    # mailparser's rules: named parts, non-text parts with a Content-ID, RTF and
+    # "attachment" parts are attachments; inline text outside an attachment is body either way.
+    disposition = headers.get_content_disposition()
+    subtype = headers.get_content_subtype()
+    if headers.get_filename():
+        is_attachment = True
+    elif headers.get('content-id') and subtype not in ('html', 'plain'):
+        is_attachment = True
+    else:
+        is_attachment = subtype == 'rtf' or disposition == 'attachment'
+    is_inline_body = (not inside_attachment and disposition == 'inline'
+                      and headers.get_content_type() in ('text/plain', 'text/html'))
+    return not is_attachment or is_inline_body
+
+def _decode_body_text(part):
+    # 7bit/8bit ASCII text is kept as it is; anything else is decoded from its transfer
+    # encoding with the part's charset, falling back to UTF-8.
+    payload = part.get_payload(decode=True)
+    transfer_encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    if transfer_encoding in ('', '7bit', '8bit') and payload.isascii():
+        return payload.decode('ascii')
+    if not payload:
         return ''
+    try:
+        text = payload.decode(part.get_content_charset('utf-8'))
+        text.encode('utf-8')
+    except (LookupError, UnicodeError):
+        text = payload.decode('utf-8', 'replace')
+    return text
+
+def _walk_body_parts(raw, start, end, default_type='text/plain', inside_attachment=False):
+    # Yields (subtype, text) for the body text parts of the message in raw[start:end], in
+    # email.message.Message.walk() order.
+    headers, body_start = _split_headers(raw, start, end, default_type)
+    maintype = headers.get_content_maintype()
+    if maintype == 'multipart':
+        boundary = headers.get_boundary()
+        if not boundary:
+            raise _IrregularMessage()
+        child_type = 'message/rfc822' if headers.get_content_subtype() == 'digest' else 'text/plain'
+        child_inside = inside_attachment or _blocks_inline(headers)
+        for part_start, part_end in _multipart_bounds(raw, body_start, end, boundary):
+            yield from _walk_body_parts(raw, part_start, part_end, child_type, child_inside)
+    elif maintype == 'message':
+        if headers.get_content_subtype() == 'delivery-status':
+            raise _IrregularMessage()
+        yield from _walk_body_parts(raw, body_start, end, 'text/plain', inside_attachment or _blocks_inline(headers))
+    elif _is_body_part(headers, inside_attachment):
+        text = _decode_body_text(_part_parser.parsebytes(raw[start:end]))
+        if text:
+            yield headers.get_content_subtype(), text
 
-def parse_eml_file(eml_path):
+class LazyMail:
+    # The subject, text_html and body that extract_subject_and_body reads, as on a mailparser
+    # object. Parsing walks up to the first HTML part; the rest is only walked when body is
+    # needed as the fallback.
+    def __init__(self, raw):
+        self.raw = raw
+        self.text_plain = []
+        self.text_html = []
+        self.text_not_managed = []
+        match = _BLANK_LINE_RE.search(raw)
+        self.subject = mailparser.parse_from_bytes(raw[:match.start() if match else len(raw)]).subject
+        self._parts = _walk_body_parts(raw, 0, len(raw))
+        while not self.text_html and self._next_part():
+            pass
+    
+    def _next_part(self):
+        if self._parts is None:
+            return False
+        try:
+            subtype, text = next(self._parts)
+        except StopIteration:
+            self._parts = None
+            return False
+        except (_IrregularMessage, RecursionError):
+            self._parts = None
+            mail = mailparser.parse_from_bytes(self.raw)
+            self.text_plain, self.text_html, self.text_not_managed = mail.text_plain, mail.text_html, mail.text_not_managed
+            return False
+        if subtype == 'html':
+            self.text_html.append(text)
+        elif subtype == 'plain':
+            self.text_plain.append(text)
+        else:
+            self.text_not_managed.append(text)
+        return True
+    
+    @property
+    def body(self):
+        while self._next_part():
+            pass
+        return "\n--- mail_boundary ---\n".join(self.text_plain + self.text_html + self.text_not_managed)
+
+def _decode_base64_message(raw):
+    if _HEADER_FIELD_RE.match(raw) or not _BASE64_LINE_RE.match(raw):
+        return raw
     try:
-        with open(eml_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-        
-        header_section = content[:1000].lower()
+        decoded = base64.b64decode(raw)
+    except ValueError:
+        return raw
+    return decoded if _HEADER_FIELD_RE.match(decoded) else raw
+
+def parse_eml_bytes(raw, lazy=True):
+    # lazy=True uses the walker above. A file is only read as a base64-encoded message when
+    # it starts with a line of base64 rather than a header field and decodes to something
+    # that starts with a header field; otherwise it is parsed as it is. lazy=False is the
+    # mailparser path, which base64-decodes every file without a Delivered-To or Received header.
+    if lazy:
+        try:
+            return LazyMail(_decode_base64_message(raw))
+        except Exception as e:
+            print(f"Error parsing eml: {e}")
+            return None
+    
+    try:
+        header_section = raw[:4000].decode('utf-8', errors='ignore')[:1000].lower()
         
         has_delivered_to = 'delivered-to:' in header_section
         has_received = 'received:' in header_section
         
         if not has_delivered_to and not has_received:
             try:
-                with open(eml_path, 'rb') as f:
-                    encoded_content = f.read()
-                
-                decoded_content = base64.b64decode(encoded_content)
+                decoded_content = base64.b64decode(raw)
                 mail = mailparser.parse_from_bytes(decoded_content)
                 return mail
                 
             except:
                 pass
         
-        mail = mailparser.parse_from_file(eml_path)
+        mail = mailparser.parse_from_bytes(raw)
         return mail
         
     except Exception as e:
         print(f"Error parsing eml: {e}")
         return None
 
-def get_email_content(eml_path):
+def parse_eml_file(eml_path, lazy=True):
+    # Read once, in binary; the header sniffing and the base64 fallback both work on these bytes.
+    try:
+        with open(eml_path, 'rb') as f:
+            raw = f.read()
+    except Exception as e:
+        print(f"Error parsing eml: {e}")
+        return None
+    
+    return parse_eml_bytes(raw, lazy)
+
+def extract_subject_and_body(mail, backend='bs4', cache=None, stats=None):
+    subject = mail.subject if mail.subject else ""
+    
+    body = ""
+    
+    if mail.text_html and len(mail.text_html) > 0:
+        first_html = mail.text_html[0]
+        if first_html:
+            body = remove_invisible_and_extract_text(first_html, backend, stats, cache)
+    
+    if not body and mail.body:
+        body = mail.body
+    
+    if not body:
+        body = ""
+    
+    return subject, body
+
+def get_email_content(eml_path, backend='bs4', cache=None, stats=None):
     try:
         mail = parse_eml_file(eml_path)
         
@@ -155,20 +845,7 @@ def get_email_content(eml_path):
             print("Failed to parse email")
             return None
         
-        subject = mail.subject if mail.subject else ""
-        
-        body = ""
-        
-        if mail.text_html and len(mail.text_html) > 0:
-            first_html = mail.text_html[0]
-            if first_html:
-                body = remove_invisible_and_extract_text(first_html)
-        
-        if not body and mail.body:
-            body = mail.body
-        
-        if not body:
-            body = ""
+        subject, body = extract_subject_and_body(mail, backend, cache, stats)
         
         email_content = f"Subject: {subject}\n\n{body}"
         return email_content
@@ -177,7 +854,226 @@ def get_email_content(eml_path):
         print(f"Error extracting content: {e}")
         return None
 
+def is_maildir(path):
+    return all(os.path.isdir(os.path.join(path, sub)) for sub in ('cur', 'new', 'tmp'))
+
+def is_mbox(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(5) == b'From '
+    except OSError:
+        return False
+
+def iter_message_paths(source, extension='.eml'):
+    if is_maildir(source):
+        for sub in ('new', 'cur'):
+            folder = os.path.join(source, sub)
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if os.path.isfile(path):
+                    yield path
+    else:
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if extension and not name.lower().endswith(extension):
+                    continue
+                yield os.path.join(root, name)
+
+def iter_raw_messages(source, extension='.eml'):
+    # Yields (path, raw_bytes) one message at a time. Maildir messages are plain files;
+    # mbox messages are addressed as "<mbox path>#<index>".
+    if os.path.isdir(source):
+        for path in iter_message_paths(source, extension):
+            with open(path, 'rb') as f:
+                yield path, f.read()
+    elif is_mbox(source):
+        box = mailbox.mbox(source, create=False)
+        try:
+            for index, key in enumerate(box.iterkeys()):
+                yield f"{source}#{index}", box.get_bytes(key)
+        finally:
+            box.close()
+    else:
+        with open(source, 'rb') as f:
+            yield source, f.read()
+
+def iter_email_contents(source, extension='.eml', backend='bs4', cache=None, stats=None):
+    # Streams (path, subject, visible_text) from a directory of .eml files, a maildir, an mbox
+    # file or a single .eml file. Messages that fail to parse come back as (path, None, None).
+    for path, raw in iter_raw_messages(source, extension):
+        try:
+            mail = parse_eml_bytes(raw)
+            if not mail:
+                yield path, None, None
+                continue
+            subject, body = extract_subject_and_body(mail, backend, cache, stats)
+            yield path, subject, body
+        except Exception as e:
+            print(f"Error extracting content: {e}")
+            yield path, None, None
+
+# PARALLEL EXTRACTION
+
+# BaseException, so the broad "except Exception" blocks in the extraction code let it through.
+class ExtractionTimeout(BaseException):
+    pass
+
+# After the timeout, the alarm repeats at this interval until the timeout escapes any bare
+# "except:" that happened to catch it.
+TIMEOUT_REPEAT_INTERVAL = 0.05
+
+_worker_timeout = None
+_worker_backend = 'bs4'
+_worker_text_cache = None
+_worker_item_active = False
+
+def _raise_timeout(signum, frame):
+    # An alarm that lands after the item has finished (say, while the finally block that
+    # disarms it is being cut short) only disarms the timer.
+    if not _worker_item_active:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        return
+    raise ExtractionTimeout()
+
+def _init_extraction_worker(timeout, backend='bs4', text_cache_path=None):
+    global _worker_timeout, _worker_backend, _worker_text_cache
+    _worker_timeout = timeout
+    _worker_backend = backend
+    if timeout and hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+    if text_cache_path is not None:
+        _worker_text_cache = VisibleTextCache(text_cache_path)
+        # Pool workers have no shutdown hook of their own; this writes their last counts.
+        multiprocessing.util.Finalize(_worker_text_cache, _worker_text_cache.close, exitpriority=10)
+
+def _extract_one(item, collect_stats=False):
+    # item is a file path, or a (key, raw_bytes) pair for messages that are not files (mbox).
+    # Returns (key, email_content, error, stats); with collect_stats, stats is this item's
+    # ExtractionStats for the parent to merge, otherwise None.
+    stats = ExtractionStats() if collect_stats else None
+    key, content, error = _extract_item(item, stats)
+    return key, content, error, stats
+
+def _extract_item(item, stats):
+    global _worker_item_active
+    key = item[0] if isinstance(item, tuple) else item
+    use_timer = bool(_worker_timeout) and hasattr(signal, 'setitimer')
+    try:
+        try:
+            _worker_item_active = True
+            if use_timer:
+                signal.setitimer(signal.ITIMER_REAL, _worker_timeout, TIMEOUT_REPEAT_INTERVAL)
+            if isinstance(item, tuple):
+                mail = parse_eml_bytes(item[1])
+                if not mail:
+                    return key, None, 'parse_failed'
+                subject, body = extract_subject_and_body(mail, _worker_backend, _worker_text_cache, stats)
+                return key, f"Subject: {subject}\n\n{body}", None
+            content = get_email_content(item, _worker_backend, _worker_text_cache, stats)
+            return key, content, None if content is not None else 'parse_failed'
+        finally:
+            _worker_item_active = False
+            if use_timer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except ExtractionTimeout:
+        _worker_item_active = False
+        if use_timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        return key, None, 'timeout'
+
+def iter_extraction_items(source, extension='.eml'):
+    # Files are sent to workers by path; mbox messages have to be sent as bytes.
+    if os.path.isdir(source):
+        yield from iter_message_paths(source, extension)
+    elif is_mbox(source):
+        yield from iter_raw_messages(source, extension)
+    else:
+        yield source
+
+def extract_parallel(items, workers=None, max_in_flight=None, ordered=True, timeout=None, backend='bs4',
+                     text_cache_path=None, stats=None):
+    # Yields (key, email_content, error) for every item; error is None, 'parse_failed' or
+    # 'timeout'. At most max_in_flight items are queued at once, so arbitrarily large
+    # sources stream through with bounded memory. The timeout (seconds) is enforced inside
+    # the worker with SIGALRM, where available. With text_cache_path, the workers share a
+    # SQLite VisibleTextCache there. With stats, an ExtractionStats, every worker counts
+    # per item and the counts are merged into stats as the results come back.
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+    items = iter(items)
+
+    collect_stats = stats is not None
+    
+    def finished(future):
+        key, content, error, item_stats = future.result()
+        if item_stats is not None:
+            stats.merge(item_stats)
+        return key, content, error
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_extraction_worker,
+                             initargs=(timeout, backend, text_cache_path)) as executor:
+        if ordered:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(_extract_one, item, collect_stats))
+                if len(pending) >= max_in_flight:
+                    yield finished(pending.popleft())
+            while pending:
+                yield finished(pending.popleft())
+        else:
+            pending = set()
+            for item in items:
+                pending.add(executor.submit(_extract_one, item, collect_stats))
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield finished(future)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield finished(future)
+
+def extract_main(argv):
+    parser = argparse.ArgumentParser(description='Extract visible email text in parallel.')
+    parser.add_argument('source', help='.eml file, directory of .eml files, maildir or mbox file')
+    parser.add_argument('-o', '--output', help='JSONL output path (default: stdout)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None, help='per-file timeout in seconds')
+    parser.add_argument('--unordered', action='store_true', help='write results as they complete')
+    parser.add_argument('--backend', choices=sorted(TEXT_BACKENDS), default='bs4')
+    parser.add_argument('--text-cache', help='SQLite visible-text cache path, shared by the workers')
+    parser.add_argument('--metrics', help='write the extraction counters here, in Prometheus text format')
+    args = parser.parse_args(argv)
+
+    stats = ExtractionStats() if args.metrics else None
+    cache = since = None
+    if args.text_cache:
+        cache = VisibleTextCache(args.text_cache)
+        since = cache.shared_counts()
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        results = extract_parallel(iter_extraction_items(args.source), workers=args.workers,
+                                   max_in_flight=args.max_in_flight, ordered=not args.unordered,
+                                   timeout=args.timeout, backend=args.backend, text_cache_path=args.text_cache,
+                                   stats=stats)
+        for key, content, error in results:
+            out.write(json.dumps({'path': key, 'content': content, 'error': error}, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if stats is not None:
+        write_prometheus(args.metrics, stats)
+    if cache is not None:
+        print(json.dumps(cache.shared_stats(since)), file=sys.stderr)
+        cache.close()
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        extract_main(sys.argv[1:])
+        sys.exit(0)
+    
     eml_file = "path/to/your/email.eml"
     
     content = get_email_content(eml_file)
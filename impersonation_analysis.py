@@ -1,26 +1,138 @@
 import sys
-from rapidfuzz.distance import DamerauLevenshtein
-import wordninja
 import csv
 import json
 import re
-from unidecode import unidecode
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import accumulate
+import os
+import time
+import gc
+import hashlib
+import heapq
+import multiprocessing.util
+import pickle
+from array import array
+from metrics import CounterStats
 csv.field_size_limit(sys.maxsize)
 
 
+# LAZY DEPENDENCIES
+
+# rapidfuzz, unidecode and wordninja are imported on first use, so importing this module
+# stays cheap; wordninja alone loads its language model at import time. Each stub replaces
+# itself with the real function on its first call.
+
+def _damerau_levenshtein(s1, s2, score_cutoff=None):
+    global _damerau_levenshtein
+    from rapidfuzz.distance import DamerauLevenshtein
+    _damerau_levenshtein = DamerauLevenshtein.distance
+    return _damerau_levenshtein(s1, s2, score_cutoff=score_cutoff)
+
+
+def _unidecode(text):
+    global _unidecode
+    from unidecode import unidecode
+    _unidecode = unidecode
+    return _unidecode(text)
+
+
+def _wordninja_split(token):
+    global _wordninja_split
+    import wordninja
+    _wordninja_split = wordninja.split
+    return _wordninja_split(token)
+
+
+def preload_dependencies():
+    # Imports everything up front, e.g. in a parent process before it forks its workers.
+    _damerau_levenshtein('', '')
+    _unidecode('')
+    _wordninja_split('')
+
+
+INVISIBLE_PATTERNS = ['200b', '200c', '200d', '2060', 'feff', '200e', '200f', '061c', '00ad']
+INVISIBLE_MARKERS = [marker for pattern in INVISIBLE_PATTERNS for marker in (f'<{pattern}>', f'<{pattern.upper()}>')]
+_INVISIBLE_MARKER_RE = re.compile('|'.join(re.escape(marker) for marker in INVISIBLE_MARKERS))
+_NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9]')
+
+
+def strip_invisible_markers(text):
+    # Most tokens carry no marker at all; the others keep the original replace order,
+    # since removing one marker can expose another.
+    if _INVISIBLE_MARKER_RE.search(text):
+        for marker in INVISIBLE_MARKERS:
+            text = text.replace(marker, '')
+    return text.lower()
+
+
+# CONFUSABLES SKELETON
+
+# Non-ASCII letters that look like an ASCII letter, after Unicode TR39 confusables.txt
+# (Cyrillic, Greek, Armenian and Latin look-alikes). unidecode transliterates many of these
+# by sound, e.g. Cyrillic р -> r and с -> s, which hides "рауре" as a spelling of "paype".
+# Only non-ASCII sources are listed, so ASCII text is never changed.
+CONFUSABLES = {
+    # Cyrillic
+    'а': 'a', 'е': 'e', 'о': 'o', 'р': 'p', 'с': 'c', 'у': 'y', 'х': 'x', 'і': 'i',
+    'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'һ': 'h', 'ӏ': 'l', 'ԛ': 'q', 'ԝ': 'w', 'ѵ': 'v', 'ү': 'y',
+    'А': 'A', 'В': 'B', 'Е': 'E', 'К': 'K', 'М': 'M', 'Н': 'H', 'О': 'O', 'Р': 'P', 'С': 'C',
+    'Т': 'T', 'У': 'Y', 'Х': 'X', 'І': 'I', 'Ј': 'J', 'Ѕ': 'S', 'Ԁ': 'D', 'Ԛ': 'Q', 'Ԝ': 'W',
+    # Greek
+    'α': 'a', 'ο': 'o', 'ρ': 'p', 'ν': 'v', 'ι': 'i', 'κ': 'k', 'υ': 'u', 'γ': 'y',
+    'Α': 'A', 'Β': 'B', 'Ε': 'E', 'Ζ': 'Z', 'Η': 'H', 'Ι': 'I', 'Κ': 'K', 'Μ': 'M', 'Ν': 'N',
+    'Ο': 'O', 'Ρ': 'P', 'Τ': 'T', 'Υ': 'Y', 'Χ': 'X',
+    # Armenian
+    'օ': 'o', 'ս': 'u', 'հ': 'h', 'ո': 'n', 'ց': 'g', 'զ': 'q',
+    # Latin
+    'ɑ': 'a', 'ɡ': 'g', 'ı': 'i', 'ȷ': 'j', 'ɩ': 'i', 'ℓ': 'l', 'ǀ': 'l', 'ʋ': 'u',
+}
+_CONFUSABLES_TABLE = str.maketrans(CONFUSABLES)
+
+
+def load_confusables(path):
+    # Adds the single-character entries of a Unicode confusables.txt whose skeleton is ASCII
+    # letters or digits, e.g. "0430 ;\t0061 ;\tMA". Returns the number of entries added.
+    global _CONFUSABLES_TABLE
+    added = 0
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split(';')
+            if len(fields) < 2:
+                continue
+            source = ''.join(chr(int(cp, 16)) for cp in fields[0].split())
+            target = ''.join(chr(int(cp, 16)) for cp in fields[1].split())
+            if len(source) == 1 and not source.isascii() and target.isascii() and target.isalnum():
+                if source not in CONFUSABLES:
+                    CONFUSABLES[source] = target
+                    added += 1
+    _CONFUSABLES_TABLE = str.maketrans(CONFUSABLES)
+    ascii_fold.cache_clear()
+    return added
+
+
+@lru_cache(maxsize=200_000)
+def ascii_fold(text):
+    if text.isascii():
+        return text.lower()
+    # One str.translate covers the common look-alikes; unidecode only runs on what is left.
+    folded = text.translate(_CONFUSABLES_TABLE)
+    if folded.isascii():
+        return folded.lower()
+    return _unidecode(folded).lower()
+
+
+def strip_special_characters(text):
+    return _NON_ALNUM_RE.sub('', text).lower()
+
+
 def remove_unicode_text_patterns(text_list):
     if isinstance(text_list, str):
         text_split_ = text_list.split()
     else:
         text_split_ = text_list
-    
-    patterns = ['200b', '200c', '200d', '2060', 'feff', '200e', '200f', '061c', '00ad']
-    result = []
-    for text in text_split_:
-        for pattern in patterns:
-            text = text.replace(f'<{pattern}>', '').replace(f'<{pattern.upper()}>', '')
-        result.append(text.lower())
-    return result
+
+    return [strip_invisible_markers(text) for text in text_split_]
 
 
 def normalize_unicode_text(text_list):
@@ -32,7 +144,7 @@ def normalize_unicode_text(text_list):
     
     result = []
     for text in text_split_:
-        ascii_text = unidecode(text).lower()
+        ascii_text = ascii_fold(text)
         if ascii_text:
             result.append(ascii_text)
     return result
@@ -47,14 +159,101 @@ def remove_special_characters(text_list):
     
     result = []
     for text in text_split_:
-        cleaned = re.sub(r'[^a-zA-Z0-9]', '', text)
+        cleaned = strip_special_characters(text)
         if cleaned:
-            result.append(cleaned.lower())
+            result.append(cleaned)
     return result
 
 
+# Stage prefixes of the result box, in cascade order.
+STAGES = ['raw_', 'invisible_', 'normalized_', 'special_']
+
+
+class TokenViews:
+    # Every stage's view of each raw token, computed once per text. A raw token has exactly
+    # one invisible view, at most one normalized view ('' when unidecode drops it), and any
+    # number of special views (unidecode output can contain spaces). The cascade then walks
+    # these arrays by raw index instead of re-joining and re-splitting strings between stages.
+    def __init__(self, text_split_):
+        self.raw = list(text_split_)
+        self.invisible = []
+        self.normalized = []
+        self.special = []
+
+        seen = {}
+        for token in self.raw:
+            token_views = seen.get(token)
+            if token_views is None:
+                invisible = strip_invisible_markers(token)
+                normalized = ascii_fold(invisible) if invisible else ''
+                special = tuple(cleaned for cleaned in map(strip_special_characters, normalized.split()) if cleaned)
+                token_views = seen[token] = (invisible, normalized, special)
+            self.invisible.append(token_views[0])
+            self.normalized.append(token_views[1])
+            self.special.append(token_views[2])
+        self._stage_indexes = {}
+
+    def to_dict(self):
+        return {'raw': self.raw, 'invisible': self.invisible, 'normalized': self.normalized,
+                'special': [list(special) for special in self.special]}
+
+    @classmethod
+    def from_dict(cls, data):
+        # Rebuilds stored views without running the normalization again.
+        views = cls.__new__(cls)
+        views.raw = list(data['raw'])
+        views.invisible = list(data['invisible'])
+        views.normalized = list(data['normalized'])
+        views.special = [tuple(special) for special in data['special']]
+        views._stage_indexes = {}
+        return views
+
+    def stage_tokens(self, prefix, kept=None):
+        # Returns the stage's tokens for the kept raw indices, and the raw index each came from.
+        if kept is None:
+            kept = range(len(self.raw))
+
+        if prefix == 'raw_':
+            return [self.raw[i] for i in kept], list(kept)
+        if prefix == 'invisible_':
+            return [self.invisible[i] for i in kept], list(kept)
+
+        tokens = []
+        owners = []
+        if prefix == 'normalized_':
+            for i in kept:
+                if self.normalized[i]:
+                    tokens.append(self.normalized[i])
+                    owners.append(i)
+        else:
+            for i in kept:
+                for token in self.special[i]:
+                    tokens.append(token)
+                    owners.append(i)
+        return tokens, owners
+
+    def stage_index(self, prefix):
+        # The StageIndex of the stage's full token list, built once and shared by every brand.
+        index = self._stage_indexes.get(prefix)
+        if index is None:
+            index = self._stage_indexes[prefix] = StageIndex(*self.stage_tokens(prefix))
+        return index
+
+
 def get_distance_levenshtein_typosquatting(my_brand, my_word):
-    return DamerauLevenshtein.distance(my_brand, my_word)
+    return _damerau_levenshtein(my_brand, my_word)
+
+
+# Callers only tell apart 0 (direct/combo), 1 (typo) and <= 2 (fuzzy), so the distance is
+# bounded: any pair further apart than max_distance comes back as max_distance + 1.
+TYPO_DISTANCE = 1
+FUZZY_DISTANCE = 2
+
+
+def get_bounded_distance(my_brand, my_word, max_distance):
+    if abs(len(my_brand) - len(my_word)) > max_distance:
+        return max_distance + 1
+    return _damerau_levenshtein(my_brand, my_word, score_cutoff=max_distance)
 
 
 def get_word(my_list, my_first, my_last):
@@ -71,92 +270,410 @@ def _empty_result_box():
     }
 
 
-def _check_substring_fallback(result_box, my_brand, original_text):
+def _hit_total(result_box):
+    return sum(result_box.values())
+
+
+def _limit_reached(result_box, limit):
+    return limit is not None and _hit_total(result_box) >= limit
+
+
+def _check_substring_fallback(result_box, my_brand, original_text, substring_hits=None):
     all_zero = all(v == 0 for k, v in result_box.items() if k != 'substring_match')
     if all_zero:
-        text_no_space = original_text.replace(' ', '')
         brand_no_space = my_brand.replace(' ', '')
-        if brand_no_space and brand_no_space in text_no_space:
+        if substring_hits is not None:
+            found = brand_no_space in substring_hits
+        else:
+            found = brand_no_space and brand_no_space in original_text.replace(' ', '')
+        if found:
             result_box['substring_match'] = 1
 
 
+# SUBSTRING AUTOMATON
+
+class SubstringAutomaton:
+    # Aho-Corasick automaton: finds every pattern occurring in a text in one pass over it,
+    # instead of one `in` scan of the whole text per pattern.
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+
+        for pattern in set(patterns):
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] = (pattern,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(ch, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def to_state(self):
+        return {'goto': self.goto, 'fail': self.fail, 'output': self.output}
+
+    @classmethod
+    def from_state(cls, state):
+        automaton = cls.__new__(cls)
+        automaton.goto = state['goto']
+        automaton.fail = state['fail']
+        automaton.output = state['output']
+        return automaton
+
+    def find(self, text):
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+# WORD SEGMENTATION CACHE
+
+class SegmentationCache:
+    # Process-wide LRU cache of wordninja.split results; the same tokens recur in every
+    # stage and across messages, and segmentation is a dynamic program over the token.
+    def __init__(self, maxsize=200_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def split(self, token):
+        parts = self._entries.get(token)
+        if parts is not None:
+            self.hits += 1
+            self._entries.move_to_end(token)
+            return parts
+
+        self.misses += 1
+        parts = tuple(_wordninja_split(token))
+        self._store(token, parts)
+        return parts
+
+    def _store(self, token, parts):
+        self._entries[token] = parts
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path):
+        # Least recently used first, so loading the snapshot restores the same order. The file
+        # is replaced in one step, so workers saving at exit never leave half a snapshot.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([[token, list(parts)] for token, parts in self._entries.items()], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        for token, parts in snapshot:
+            self._store(token, tuple(parts))
+
+
+segmentation_cache = SegmentationCache()
+
+
+def split_words(token):
+    return segmentation_cache.split(token)
+
+
+# INSTRUMENTATION
+
+class CascadeStats(CounterStats):
+    # Counters for the detection cascade, passed as stats= to check_impersonation_one_word,
+    # check_impersonation_multiple_words or BrandMatcher.match. Without one, the cascade only
+    # pays for a few "is None" checks. on_stage, if given, is called as
+    # on_stage(prefix, tokens_in, tokens_out, seconds) after every stage run.
+    NAMESPACE = 'impersonation'
+    CALLBACKS = ('on_stage',)
+    METRICS = (
+        ('checks', 'checks_total', 'Brand checks run.'),
+        ('hits', 'hits_total', 'Brand checks with at least one hit.'),
+        ('skipped_brands', 'skipped_brands_total', 'Brands skipped by the BrandMatcher prefilter.'),
+        ('early_exits', 'early_exits_total', 'Cascades that stopped before the special stage.'),
+        ('distance_calls', 'distance_calls_total', 'Bounded Damerau-Levenshtein calls.'),
+        ('pruned_pairs', 'pruned_pairs_total', 'Token or window comparisons skipped by the length buckets.'),
+        ('segmented_tokens', 'segmented_tokens_total', 'Tokens passed to wordninja segmentation.'),
+        ('segmentation_seconds', 'segmentation_seconds_total', 'Time spent in wordninja segmentation.'),
+        ('views_built', 'views_built_total', 'Token views built.'),
+        ('views_seconds', 'views_seconds_total', 'Time spent building token views.'),
+        ('stage_runs', 'stage_runs_total', 'Cascade stage runs.', 'stage'),
+        ('stage_seconds', 'stage_seconds_total', 'Wall time per cascade stage, including segmentation.', 'stage'),
+        ('tokens_in', 'stage_tokens_in_total', 'Tokens entering each cascade stage.', 'stage'),
+        ('tokens_out', 'stage_tokens_out_total', 'Tokens left over after each cascade stage.', 'stage'),
+        ('exits_after', 'stage_early_exits_total', 'Cascades that stopped at each stage.', 'stage'),
+    )
+
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.checks = 0
+        self.hits = 0
+        self.skipped_brands = 0
+        self.early_exits = 0
+        self.distance_calls = 0
+        self.pruned_pairs = 0
+        self.segmented_tokens = 0
+        self.segmentation_seconds = 0.0
+        self.views_built = 0
+        self.views_seconds = 0.0
+        self.stage_runs = dict.fromkeys(STAGES, 0)
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.tokens_in = dict.fromkeys(STAGES, 0)
+        self.tokens_out = dict.fromkeys(STAGES, 0)
+        self.exits_after = dict.fromkeys(STAGES, 0)
+
+    def record_stage(self, prefix, tokens_in, tokens_out, seconds):
+        self.stage_runs[prefix] += 1
+        self.stage_seconds[prefix] += seconds
+        self.tokens_in[prefix] += tokens_in
+        self.tokens_out[prefix] += tokens_out
+        if self.on_stage is not None:
+            self.on_stage(prefix, tokens_in, tokens_out, seconds)
+
+    def record_early_exit(self, prefix):
+        # The cascade stopped at prefix because no tokens were left for the following stages.
+        self.early_exits += 1
+        self.exits_after[prefix] += 1
+
+    def record_segmentation(self, token_count, seconds):
+        self.segmented_tokens += token_count
+        self.segmentation_seconds += seconds
+
+    def record_views(self, seconds):
+        self.views_built += 1
+        self.views_seconds += seconds
+
+    def record_check(self, result_box):
+        self.checks += 1
+        if any(result_box.values()):
+            self.hits += 1
+
+
+def _build_views(text_split_, stats=None):
+    if stats is None:
+        return TokenViews(text_split_)
+    started = time.perf_counter()
+    views = TokenViews(text_split_)
+    stats.record_views(time.perf_counter() - started)
+    return views
+
+
+# LENGTH BUCKETS
+
+def _bucket_range(buckets, length, max_distance):
+    # The entries of the buckets within max_distance of length, in their original order.
+    found = []
+    for bucket_length in range(length - max_distance, length + max_distance + 1):
+        found.extend(buckets.get(bucket_length, ()))
+    found.sort()
+    return found
+
+
+class StageIndex:
+    # One stage's tokens of a message and their wordninja parts, each with TokenWindows whose
+    # length buckets are shared by every brand. A pair further apart in length than the
+    # distance bound cannot match, so a detector only compares a brand with the windows in
+    # the buckets around its length; every other token is left over without being looked at.
+    def __init__(self, tokens, owners):
+        self.tokens = tokens
+        self.owners = owners
+        self.windows = TokenWindows(tokens)
+        self._parts = None
+        self._part_windows = None
+
+    def parts(self, stats=None):
+        # (parts, parents) as segment_with_parents returns them, segmented on first use.
+        if self._parts is None:
+            started = time.perf_counter() if stats is not None else None
+            self._parts = segment_with_parents(self.tokens)
+            if stats is not None:
+                stats.record_segmentation(len(self.tokens), time.perf_counter() - started)
+        return self._parts
+
+    def part_windows(self, stats=None):
+        if self._part_windows is None:
+            self._part_windows = TokenWindows(self.parts(stats)[0])
+        return self._part_windows
+
+    def subset(self, positions):
+        return StageIndex([self.tokens[position] for position in positions],
+                          [self.owners[position] for position in positions])
+
+
 # ONE-WORD BRAND FUNCTIONS
 
 def seperate_word_check_one_word_with_origin(my_list):
     tracked = []
     for orig_idx, orig_token in enumerate(my_list):
-        parts = wordninja.split(orig_token)
+        parts = split_words(orig_token)
         for sub_token in parts:
             tracked.append((orig_idx, orig_token, sub_token))
     return tracked
 
 
-def process_detection_oneword(text_split_, my_brand, result_box, prefix):
+def detect_oneword_matches(index, my_brand, result_box, prefix, stats=None, limit=None):
+    # Returns the positions of index.tokens that matched, or None once the box holds limit
+    # hits (nothing is left over then). Only the tokens and parts in the length buckets
+    # around the brand are compared; the stage's parts are segmented once for all brands.
     # ---------------- STEP 1: direct / typo ----------------
-    remaining = []
+    tokens = index.tokens
+    matched = set()
+    distance_calls = 0
+    candidates = index.windows.candidate_starts(1, my_brand, TYPO_DISTANCE)
+    if stats is not None:
+        stats.pruned_pairs += len(tokens) - len(candidates)
 
-    for tok in text_split_:
-        dist = get_distance_levenshtein_typosquatting(my_brand, tok)
+    for position in candidates:
+        distance_calls += 1
+        dist = get_bounded_distance(my_brand, tokens[position], TYPO_DISTANCE)
 
         if dist == 0:
             result_box[f'{prefix}direct'] += 1
         elif dist == 1:
             result_box[f'{prefix}typo'] += 1
         else:
-            remaining.append(tok)
+            continue
+        matched.add(position)
+        if _limit_reached(result_box, limit):
+            if stats is not None:
+                stats.distance_calls += distance_calls
+            return None
 
-    if not remaining:
-        return ""
+    if len(matched) == len(tokens):
+        if stats is not None:
+            stats.distance_calls += distance_calls
+        return matched
 
-    tracked = seperate_word_check_one_word_with_origin(remaining)
+    # ---------------- STEP 2: combo / fuzzy on the wordninja parts ----------------
+    ninja_tokens, parents = index.parts(stats)
+    candidates = [child for child in index.part_windows(stats).candidate_starts(1, my_brand, FUZZY_DISTANCE)
+                  if parents[child] not in matched]
+    if stats is not None:
+        left_over_parts = sum(1 for parent in parents if parent not in matched) if matched else len(ninja_tokens)
+        stats.pruned_pairs += left_over_parts - len(candidates)
 
-    remove_orig = set()
-    for orig_idx, orig_token, sub_token in tracked:
-        if orig_idx in remove_orig:
+    for child in candidates:
+        position = parents[child]
+        if position in matched:
             continue
 
-        dist = get_distance_levenshtein_typosquatting(my_brand, sub_token)
+        distance_calls += 1
+        dist = get_bounded_distance(my_brand, ninja_tokens[child], FUZZY_DISTANCE)
 
         if dist == 0:
             result_box[f'{prefix}combo'] += 1
-            remove_orig.add(orig_idx)
         elif 1 <= dist <= 2:
             result_box[f'{prefix}fuzzy'] += 1
-            remove_orig.add(orig_idx)
+        else:
+            continue
+        matched.add(position)
+        if _limit_reached(result_box, limit):
+            matched = None
+            break
 
-    remaining = [tok for i, tok in enumerate(remaining) if i not in remove_orig]
-    return " ".join(remaining)
+    if stats is not None:
+        stats.distance_calls += distance_calls
+    return matched
 
 
-def check_impersonation_one_word(input_my_brand, input_text_split_, original_text):
-    my_brand = input_my_brand
+def detect_oneword_positions(text_split_, my_brand, result_box, prefix, stats=None, limit=None):
+    # Returns the positions in text_split_ left over for the next stage. Once the box holds
+    # limit hits, nothing is left over and the cascade stops.
+    matched = detect_oneword_matches(StageIndex(text_split_, None), my_brand, result_box, prefix, stats, limit)
+    if matched is None:
+        return []
+    return [position for position in range(len(text_split_)) if position not in matched]
 
-    result_box = _empty_result_box()
 
-    text_after_raw = process_detection_oneword(input_text_split_.copy(), my_brand, result_box, prefix='raw_')
+def process_detection_oneword(text_split_, my_brand, result_box, prefix):
+    remaining = detect_oneword_positions(text_split_, my_brand, result_box, prefix)
+    return " ".join(text_split_[position] for position in remaining)
 
-    if not text_after_raw:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
 
-    text_clean = remove_unicode_text_patterns(text_after_raw)
-    text_after_invisible = process_detection_oneword(text_clean, my_brand, result_box, prefix='invisible_')
+def _run_cascade(views, detect_matches, stats=None):
+    # raw -> invisible -> normalized -> special; each stage only sees the raw tokens that
+    # no earlier stage matched. detect_matches(index, prefix) returns the matched positions
+    # of the StageIndex, or None to stop. While nothing has matched, every brand shares the
+    # views' stage indexes; after a hit, the stage's leftover tokens get an index of their own.
+    kept = None
+    for prefix in STAGES:
+        index = views.stage_index(prefix)
+        if kept is not None:
+            index = index.subset([position for position, owner in enumerate(index.owners) if owner in kept])
+        tokens_in = len(index.tokens)
+        if not tokens_in:
+            if stats is not None:
+                stats.record_early_exit(prefix)
+            return
+        started = time.perf_counter() if stats is not None else None
+        matched = detect_matches(index, prefix)
+        tokens_out = 0 if matched is None else tokens_in - len(matched)
+        if stats is not None:
+            stats.record_stage(prefix, tokens_in, tokens_out, time.perf_counter() - started)
+        if not tokens_out:
+            if prefix != STAGES[-1] and stats is not None:
+                stats.record_early_exit(prefix)
+            return
+        if matched:
+            kept = {owner for position, owner in enumerate(index.owners) if position not in matched}
 
-    if not text_after_invisible:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
 
-    text_normalized = normalize_unicode_text(text_after_invisible)
-    text_after_normalized = process_detection_oneword(text_normalized, my_brand, result_box, prefix='normalized_')
+def check_impersonation_one_word(input_my_brand, input_text_split_, original_text, views=None, substring_hits=None,
+                                 stats=None, limit=None):
+    # With limit, counting stops once the box holds that many hits (limit=1 answers "any hit").
+    my_brand = input_my_brand
 
-    if not text_after_normalized:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
+    result_box = _empty_result_box()
 
-    text_special = remove_special_characters(text_after_normalized)
-    process_detection_oneword(text_special, my_brand, result_box, prefix='special_')
+    if views is None:
+        views = _build_views(input_text_split_, stats)
+    _run_cascade(views, lambda index, prefix: detect_oneword_matches(index, my_brand, result_box, prefix, stats, limit),
+                 stats)
 
-    _check_substring_fallback(result_box, my_brand, original_text)
+    _check_substring_fallback(result_box, my_brand, original_text, substring_hits)
+    if stats is not None:
+        stats.record_check(result_box)
 
     return result_box
 
@@ -168,7 +685,7 @@ def seperate_word_check_multiword_with_origin(my_list):
     child_idx = 0
     
     for orig_idx, orig_token in enumerate(my_list):
-        parts = wordninja.split(orig_token)
+        parts = split_words(orig_token)
         for sub_token in parts:
             tracked.append((orig_idx, orig_token, sub_token, child_idx))
             child_parent_dict[child_idx] = orig_idx
@@ -178,80 +695,154 @@ def seperate_word_check_multiword_with_origin(my_list):
 
 
 
-def process_detection_multiword(text_split_, my_brand, brand_count, result_box, prefix):
-    remove_token = [False] * len(text_split_)
-    index = 0
+class TokenWindows:
+    # Running character offsets of a token list, so the length of the space-joined window
+    # tokens[first:last] is known without joining it. Windows whose length alone puts them
+    # further than max_distance from the brand are never built or compared.
+    # The first candidate_starts call for a window size scans the offsets; from the second on
+    # (the next brand with that many words), the windows are bucketed by length once and
+    # only the buckets around the brand's length are read.
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.offsets = array('i', accumulate(map(len, tokens), initial=0))
+        self._buckets = {}
+        self._scanned = set()
+
+    def window_length(self, first, last):
+        return self.offsets[last] - self.offsets[first] + last - first - 1
+
+    def window_count(self, brand_count):
+        return max(len(self.tokens) - brand_count + 1, 0)
+
+    def length_buckets(self, brand_count):
+        # {length of the joined window: [start, ...]} over the windows of brand_count tokens.
+        buckets = self._buckets.get(brand_count)
+        if buckets is None:
+            buckets = self._buckets[brand_count] = {}
+            spaces = brand_count - 1
+            for start, (first, last) in enumerate(zip(self.offsets, self.offsets[brand_count:])):
+                length = last - first + spaces
+                bucket = buckets.get(length)
+                if bucket is None:
+                    buckets[length] = [start]
+                else:
+                    bucket.append(start)
+        return buckets
+
+    def candidate_starts(self, brand_count, my_brand, max_distance):
+        # Start indices of the brand_count-token windows whose length is within max_distance
+        # of the brand's, in order.
+        if brand_count not in self._buckets and brand_count not in self._scanned:
+            self._scanned.add(brand_count)
+            offsets = self.offsets
+            target = len(my_brand) - (brand_count - 1)
+            return [index for index in range(len(self.tokens) - brand_count + 1)
+                    if abs(offsets[index + brand_count] - offsets[index] - target) <= max_distance]
+        return _bucket_range(self.length_buckets(brand_count), len(my_brand), max_distance)
+
+    def distance(self, my_brand, first, last, max_distance):
+        return _damerau_levenshtein(my_brand, ' '.join(self.tokens[first:last]), score_cutoff=max_distance)
+
+
+def segment_with_parents(my_list):
+    # Compact form of seperate_word_check_multiword_with_origin: the wordninja parts of every
+    # token, and parents[child] = index in my_list of the token the part came from.
+    ninja_tokens = []
+    parents = array('i')
+    split = segmentation_cache.split
+    for orig_idx, orig_token in enumerate(my_list):
+        parts = split(orig_token)
+        ninja_tokens.extend(parts)
+        parents.extend([orig_idx] * len(parts))
+    return ninja_tokens, parents
+
+
+def detect_multiword_matches(index, my_brand, brand_count, result_box, prefix, stats=None, limit=None):
+    # Returns the positions of index.tokens that matched, or None once the box holds limit
+    # hits. Windows are slid left to right; only those in the length buckets around the brand
+    # are joined and compared, and a match moves the next window past its tokens. Windows
+    # therefore never overlap a matched one.
+    tokens = index.tokens
+    matched = set()
+    windows = index.windows
+    candidates = windows.candidate_starts(brand_count, my_brand, TYPO_DISTANCE)
+    if stats is not None:
+        stats.pruned_pairs += windows.window_count(brand_count) - len(candidates)
+    next_index = 0
+    distance_calls = 0
     
-    while index <= len(text_split_) - brand_count:
-        if any(remove_token[i] for i in range(index, index + brand_count)):
-            index += 1
+    for start in candidates:
+        if start < next_index:
             continue
         
-        word_extracted = get_word(text_split_, index, index + brand_count)
-        dist = get_distance_levenshtein_typosquatting(my_brand, word_extracted)
-        
+        distance_calls += 1
+        dist = windows.distance(my_brand, start, start + brand_count, TYPO_DISTANCE)
         if dist == 0:
             result_box[f'{prefix}direct'] += 1
-            for i in range(index, index + brand_count):
-                remove_token[i] = True
-            index += brand_count
         elif dist == 1:
             result_box[f'{prefix}typo'] += 1
-            for i in range(index, index + brand_count):
-                remove_token[i] = True
-            index += brand_count
         else:
-            index += 1
-    
-    text_split_ = [tok for i, tok in enumerate(text_split_) if not remove_token[i]]
-    
-    if not text_split_:
-        return ""
-    
-    tracked, child_parent_dict = seperate_word_check_multiword_with_origin(text_split_)
-    ninja_tokens = [t[2] for t in tracked]
+            continue
+        if _limit_reached(result_box, limit):
+            if stats is not None:
+                stats.distance_calls += distance_calls
+            return None
+        matched.update(range(start, start + brand_count))
+        next_index = start + brand_count
     
-    if len(ninja_tokens) < brand_count:
-        return " ".join(text_split_)
+    if len(matched) == len(tokens):
+        if stats is not None:
+            stats.distance_calls += distance_calls
+        return matched
     
-    remove_orig = set()
-    remove_child = set()
+    # The parts of the leftover tokens are windowed afresh, so after a typo-pass match the
+    # leftovers get an index of their own; positions maps its parents back to index.tokens.
+    positions = range(len(tokens))
+    leftover = index
+    if matched:
+        positions = [position for position in positions if position not in matched]
+        leftover = StageIndex([tokens[position] for position in positions], None)
+    ninja_tokens, parents = leftover.parts(stats)
+    windows = leftover.part_windows(stats)
+    candidates = windows.candidate_starts(brand_count, my_brand, FUZZY_DISTANCE)
+    if stats is not None:
+        stats.pruned_pairs += windows.window_count(brand_count) - len(candidates)
     max_child_idx = len(ninja_tokens) - 1
     
-    index = 0
-    while index <= len(ninja_tokens) - brand_count:
-        if any(i in remove_child for i in range(index, index + brand_count)):
-            index += 1
+    next_index = 0
+    for start in candidates:
+        if start < next_index:
             continue
         
-        word_extracted = get_word(ninja_tokens, index, index + brand_count)
-        dist = get_distance_levenshtein_typosquatting(my_brand, word_extracted)
-        
-        if dist == 0 or (1 <= dist <= 2):
-            first_index = index
-            last_index = index + brand_count - 1
+        distance_calls += 1
+        dist = windows.distance(my_brand, start, start + brand_count, FUZZY_DISTANCE)
+        if dist <= FUZZY_DISTANCE:
+            first_index = start
+            last_index = start + brand_count - 1
             
             if len(ninja_tokens) == brand_count:
                 label = 'typo'
             else:
+                # The match only counts as combo/fuzzy when a neighbouring part comes from the
+                # same original token as the window's edge, i.e. the brand was glued to it.
                 is_boundary_shared = False
                 if first_index == 0:
                     last_index_inspect = last_index + 1
                     if last_index_inspect <= max_child_idx and \
-                       child_parent_dict[last_index_inspect] == child_parent_dict[last_index]:
+                       parents[last_index_inspect] == parents[last_index]:
                         is_boundary_shared = True
                 elif last_index == max_child_idx:
                     first_index_inspect = first_index - 1
                     if first_index_inspect >= 0 and \
-                       child_parent_dict[first_index_inspect] == child_parent_dict[first_index]:
+                       parents[first_index_inspect] == parents[first_index]:
                         is_boundary_shared = True
                 else:
                     first_index_inspect = first_index - 1
                     last_index_inspect = last_index + 1
                     if (first_index_inspect >= 0 and
-                        child_parent_dict[first_index_inspect] == child_parent_dict[first_index]) or \
+                        parents[first_index_inspect] == parents[first_index]) or \
                        (last_index_inspect <= max_child_idx and
-                        child_parent_dict[last_index_inspect] == child_parent_dict[last_index]):
+                        parents[last_index_inspect] == parents[last_index]):
                         is_boundary_shared = True
                 
                 if is_boundary_shared:
@@ -260,59 +851,58 @@ def process_detection_multiword(text_split_, my_brand, brand_count, result_box,
                     label = 'typo'
             
             result_box[f'{prefix}{label}'] += 1
+            if _limit_reached(result_box, limit):
+                matched = None
+                break
             
             for i in range(first_index, last_index + 1):
-                remove_child.add(i)
-                remove_orig.add(child_parent_dict[i])
+                matched.add(positions[parents[i]])
             
-            index = last_index + 1
-        else:
-            index += 1
+            next_index = last_index + 1
     
-    text_split_ = [tok for i, tok in enumerate(text_split_) if i not in remove_orig]
-    return " ".join(text_split_)
+    if stats is not None:
+        stats.distance_calls += distance_calls
+    return matched
 
 
+def detect_multiword_positions(text_split_, my_brand, brand_count, result_box, prefix, stats=None, limit=None):
+    # Returns the positions in text_split_ left over for the next stage; none once the box
+    # holds limit hits.
+    matched = detect_multiword_matches(StageIndex(text_split_, None), my_brand, brand_count, result_box, prefix,
+                                       stats, limit)
+    if matched is None:
+        return []
+    return [position for position in range(len(text_split_)) if position not in matched]
 
-def check_impersonation_multiple_words(input_my_brand, input_brand_count, input_text_split_, original_text):
-    my_brand = input_my_brand
-    brand_count = input_brand_count
-
-    result_box = _empty_result_box()
-
-    text_after_raw = process_detection_multiword(
-        input_text_split_.copy(), my_brand, brand_count, result_box, prefix='raw_'
-    )
-    
-    if not text_after_raw:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
 
-    text_clean = remove_unicode_text_patterns(text_after_raw)
-    text_after_invisible = process_detection_multiword(text_clean, my_brand, brand_count, result_box, prefix='invisible_')
+def process_detection_multiword(text_split_, my_brand, brand_count, result_box, prefix):
+    remaining = detect_multiword_positions(text_split_, my_brand, brand_count, result_box, prefix)
+    return " ".join(text_split_[position] for position in remaining)
 
-    if not text_after_invisible:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
 
-    text_normalized = normalize_unicode_text(text_after_invisible)
-    text_after_normalized = process_detection_multiword(text_normalized, my_brand, brand_count, result_box, prefix='normalized_')
+def check_impersonation_multiple_words(input_my_brand, input_brand_count, input_text_split_, original_text,
+                                       views=None, substring_hits=None, stats=None, limit=None):
+    my_brand = input_my_brand
+    brand_count = input_brand_count
 
-    if not text_after_normalized:
-        _check_substring_fallback(result_box, my_brand, original_text)
-        return result_box
+    result_box = _empty_result_box()
 
-    text_special = remove_special_characters(text_after_normalized)
-    process_detection_multiword(text_special, my_brand, brand_count, result_box, prefix='special_')
+    if views is None:
+        views = _build_views(input_text_split_, stats)
+    _run_cascade(views, lambda index, prefix: detect_multiword_matches(index, my_brand, brand_count, result_box,
+                                                                       prefix, stats, limit),
+                 stats)
 
-    _check_substring_fallback(result_box, my_brand, original_text)
+    _check_substring_fallback(result_box, my_brand, original_text, substring_hits)
+    if stats is not None:
+        stats.record_check(result_box)
 
     return result_box
 
 
 # MAIN FUNCTION
 
-def main(my_brand, my_text):
+def main(my_brand, my_text, limit=None):
     if not my_brand or not my_brand.strip():
         return _empty_result_box()
 
@@ -321,11 +911,414 @@ def main(my_brand, my_text):
     text_split_ = my_text.split()
     
     if brand_count == 1:
-        return check_impersonation_one_word(my_brand, text_split_, my_text)
+        return check_impersonation_one_word(my_brand, text_split_, my_text, limit=limit)
+    else:
+        return check_impersonation_multiple_words(my_brand, brand_count, text_split_, my_text, limit=limit)
+
+
+# MULTI-BRAND MATCHER
+
+# A distance within FUZZY_DISTANCE is impossible when the lengths differ by more.
+MAX_LENGTH_SLACK = FUZZY_DISTANCE
+
+# Weights of score_result_box(): exact spellings count more than edited ones, and spellings
+# hidden behind invisible or look-alike characters more than plain ones.
+MATCH_WEIGHTS = {'direct': 1.0, 'combo': 0.8, 'typo': 0.6, 'fuzzy': 0.4}
+STAGE_WEIGHTS = {'raw_': 1.0, 'invisible_': 1.5, 'normalized_': 1.5, 'special_': 1.2}
+SUBSTRING_WEIGHT = 0.2
+
+
+def score_result_box(result_box):
+    score = SUBSTRING_WEIGHT * result_box['substring_match']
+    for prefix, stage_weight in STAGE_WEIGHTS.items():
+        for kind, match_weight in MATCH_WEIGHTS.items():
+            score += stage_weight * match_weight * result_box[f'{prefix}{kind}']
+    return score
+
+
+class BrandMatcher:
+    # With substring_gate=True, only brands whose space-free name occurs in the raw or the
+    # special-stage text go through the fuzzy cascade. That is much cheaper on large catalogs,
+    # but typo-only and fuzzy-only impersonations of other brands are no longer counted.
+    def __init__(self, brands, substring_gate=False):
+        self.brands = []
+        self.brand_counts = set()
+        self.shape_index = {}
+        self.one_word_brands = set()
+        self.substring_gate = substring_gate
+
+        seen = set()
+        for my_brand in brands:
+            if my_brand in seen:
+                continue
+            seen.add(my_brand)
+            self.brands.append(my_brand)
+            if not my_brand or not my_brand.strip():
+                continue
+            shape = self._shape(my_brand)
+            self.brand_counts.add(shape[0])
+            self.shape_index.setdefault(shape, []).append(my_brand)
+            if shape[0] == 1 and ' ' not in my_brand:
+                self.one_word_brands.add(my_brand)
+
+        self.automaton = SubstringAutomaton(my_brand.replace(' ', '') for my_brand in self.brands)
+
+    def to_state(self):
+        # Plain containers only, so the state can be stored without pickling class references.
+        return {
+            'brands': self.brands,
+            'brand_counts': self.brand_counts,
+            'shape_index': self.shape_index,
+            'one_word_brands': self.one_word_brands,
+            'substring_gate': self.substring_gate,
+            'automaton': self.automaton.to_state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        matcher = cls.__new__(cls)
+        matcher.brands = state['brands']
+        matcher.brand_counts = state['brand_counts']
+        matcher.shape_index = state['shape_index']
+        matcher.one_word_brands = state['one_word_brands']
+        matcher.substring_gate = state['substring_gate']
+        matcher.automaton = SubstringAutomaton.from_state(state['automaton'])
+        return matcher
+
+    @staticmethod
+    def _shape(my_brand):
+        return len(my_brand.split()), len(my_brand)
+
+    def substring_hits(self, my_text):
+        # Space-free brand names found in the space-free text, as the substring fallback sees it.
+        return self.automaton.find(my_text.replace(' ', ''))
+
+    def candidates(self, views, stats=None):
+        # A brand can only produce a hit if some window of the same token count, in some
+        # stage, before or after wordninja segmentation, is within MAX_LENGTH_SLACK of it.
+        # Windows are taken over the full stage views: a stage only loses tokens after a hit.
+        # The length buckets read here are the ones the detectors use afterwards.
+        shapes = set()
+        for prefix in STAGES:
+            index = views.stage_index(prefix)
+            for brand_count in self.brand_counts:
+                part_buckets = index.part_windows(stats).length_buckets(brand_count)
+                for length in index.windows.length_buckets(brand_count).keys() | part_buckets.keys():
+                    shapes.add((brand_count, length))
+
+        found = set()
+        for brand_count, length in shapes:
+            for delta in range(-MAX_LENGTH_SLACK, MAX_LENGTH_SLACK + 1):
+                found.update(self.shape_index.get((brand_count, length + delta), ()))
+        return found
+
+    def _gated(self, candidates, views, substring_hits):
+        special_tokens, _ = views.stage_tokens('special_')
+        gate_hits = substring_hits | self.automaton.find(''.join(special_tokens))
+        return {my_brand for my_brand in candidates if my_brand.replace(' ', '') in gate_hits}
+
+    def match(self, my_text, stats=None, views=None, limit=None, brands=None):
+        # views, if given, must be the TokenViews of my_text.split(), e.g. loaded from storage.
+        # With limit, each brand's counting stops at that many hits; brands restricts the
+        # result to a subset of the catalog.
+        text_split_ = my_text.split()
+        if views is None:
+            views = _build_views(text_split_, stats)
+        substring_hits = self.substring_hits(my_text)
+        candidates = self.candidates(views, stats)
+        if self.substring_gate:
+            candidates = self._gated(candidates, views, substring_hits)
+
+        results = {}
+        for my_brand in self.brands if brands is None else brands:
+            if not my_brand or not my_brand.strip():
+                results[my_brand] = _empty_result_box()
+                continue
+
+            brand_count = len(my_brand.split())
+            if my_brand not in candidates:
+                result_box = _empty_result_box()
+                _check_substring_fallback(result_box, my_brand, my_text, substring_hits)
+                if stats is not None:
+                    stats.skipped_brands += 1
+            elif brand_count == 1:
+                result_box = check_impersonation_one_word(my_brand, text_split_, my_text, views, substring_hits, stats,
+                                                          limit)
+            else:
+                result_box = check_impersonation_multiple_words(my_brand, brand_count, text_split_, my_text,
+                                                                views, substring_hits, stats, limit)
+            results[my_brand] = result_box
+        return results
+
+    def any_hits(self, my_text, stats=None, views=None):
+        # {brand: True/False}, whether match() would give the brand any hit. A one-word brand
+        # equal to some normalized token is a direct hit by the normalized stage at the latest,
+        # so those brands are settled by a set lookup; the rest stop at their first hit.
+        if views is None:
+            views = _build_views(my_text.split(), stats)
+        found = self.one_word_brands.intersection(views.normalized)
+        results = {my_brand: True for my_brand in found}
+        pending = [my_brand for my_brand in self.brands if my_brand not in found]
+        for my_brand, result_box in self.match(my_text, stats, views, limit=1, brands=pending).items():
+            results[my_brand] = any(result_box.values())
+        return {my_brand: results[my_brand] for my_brand in self.brands}
+
+    def top_brands(self, my_text, k=5, score=score_result_box, stats=None, views=None, limit=None):
+        # The k brands with the highest score, as (brand, score, result_box), best first.
+        # Brands without a hit are left out; limit caps the counting as in match().
+        results = self.match(my_text, stats, views, limit)
+        scored = [(my_brand, score(result_box), result_box) for my_brand, result_box in results.items()
+                  if any(result_box.values())]
+        return heapq.nlargest(k, scored, key=lambda item: item[1])
+
+
+# COMPILED CATALOG
+
+# A catalog artifact is CATALOG_MAGIC, an 8-byte little-endian header length, a JSON header,
+# and the pickled BrandMatcher state (brands, shape index, one-word brand set, substring automaton).
+CATALOG_MAGIC = b'IACATLG1'
+CATALOG_FORMAT_VERSION = 2
+
+
+def catalog_rules_hash():
+    # Normalized views and the shape index depend on these; an artifact built with other rules is
+    # rejected instead of silently matching differently.
+    payload = json.dumps([INVISIBLE_PATTERNS, sorted(CONFUSABLES.items()), TYPO_DISTANCE, FUZZY_DISTANCE],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_brands(brands_path, column='brand', id_column='brand_id'):
+    # The one brand catalog format: a CSV with a header naming the brand column and,
+    # optionally, a brand_id column; without that header every row's first column is a
+    # brand, so a plain list of brands, one per line, also works. Returns {brand_id:
+    # spelling}; brands without an id are their own id.
+    with open(brands_path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+        rows = list(csv.reader(f))
+    index, id_index = 0, None
+    if rows and column in rows[0]:
+        index = rows[0].index(column)
+        if id_column in rows[0]:
+            id_index = rows[0].index(id_column)
+        rows = rows[1:]
+    catalog = {}
+    for row in rows:
+        if len(row) <= index or not row[index].strip():
+            continue
+        my_brand = row[index].strip()
+        brand_id = row[id_index].strip() if id_index is not None and len(row) > id_index else ''
+        catalog[brand_id or my_brand] = my_brand
+    return catalog
+
+
+def compile_catalog(brands, artifact_path, lowercase=True, substring_gate=False):
+    if lowercase:
+        brands = [my_brand.lower() for my_brand in brands]
+    matcher = BrandMatcher(brands, substring_gate)
+    header = json.dumps({
+        'format_version': CATALOG_FORMAT_VERSION,
+        'rules_hash': catalog_rules_hash(),
+        'lowercase': lowercase,
+        'brand_count': len(matcher.brands),
+    }).encode('utf-8')
+    payload = pickle.dumps(matcher.to_state(), protocol=pickle.HIGHEST_PROTOCOL)
+    with open(artifact_path, 'wb') as f:
+        f.write(CATALOG_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.write(payload)
+    return matcher
+
+
+def load_compiled_catalog(artifact_path, freeze=False):
+    # Returns (matcher, header). The artifact is a pickle cache of a catalog you compiled
+    # yourself: unpickling can run code, so never load one from an untrusted source. Load it
+    # in the parent before a fork-based pool starts and the children share the parent's pages
+    # copy-on-write; freeze=True then calls gc.freeze(), which keeps the collector from
+    # touching (and copying) them, for the rest of the process. Reference counting still
+    # dirties the pages it updates.
+    with open(artifact_path, 'rb') as f:
+        if f.read(len(CATALOG_MAGIC)) != CATALOG_MAGIC:
+            raise ValueError(f"{artifact_path} is not a compiled brand catalog")
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        if header['format_version'] != CATALOG_FORMAT_VERSION or header['rules_hash'] != catalog_rules_hash():
+            raise ValueError(f"{artifact_path} was compiled with other rules; compile it again")
+        matcher = BrandMatcher.from_state(pickle.load(f))
+    if freeze:
+        gc.freeze()
+    return matcher, header
+
+
+# BATCH PROCESSING
+
+RESULT_FIELDS = list(_empty_result_box().keys())
+
+_worker_matcher = None
+_worker_lowercase = True
+
+
+def iter_messages(input_path, id_field='message_id', text_field='text'):
+    if input_path.endswith('.jsonl'):
+        with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                yield str(record[id_field]), record.get(text_field) or ''
+    else:
+        with open(input_path, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            for row in csv.DictReader(f):
+                yield row[id_field], row.get(text_field) or ''
+
+
+def _chunked(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_match_worker(brands, lowercase, catalog_path=None, segmentation_cache_path=None):
+    # Process-pool initializer shared by check_impersonation_batch and the pipeline.
+    global _worker_matcher, _worker_lowercase
+    _worker_lowercase = lowercase
+    if segmentation_cache_path is not None:
+        # Starts from an earlier run's snapshot, if there is one. Every worker writes its cache
+        # back when it exits; the last one to exit leaves the snapshot for the next run.
+        if os.path.exists(segmentation_cache_path):
+            segmentation_cache.load(segmentation_cache_path)
+        multiprocessing.util.Finalize(segmentation_cache, segmentation_cache.save, args=(segmentation_cache_path,),
+                                      exitpriority=10)
+    if catalog_path is not None:
+        # Forked workers already hold the parent's catalog; spawned ones load it themselves.
+        if _worker_matcher is None:
+            _worker_matcher, _ = load_compiled_catalog(catalog_path)
+        return
+    if lowercase:
+        brands = [my_brand.lower() for my_brand in brands]
+    _worker_matcher = BrandMatcher(brands)
+
+
+def _load_worker_catalog(catalog_path):
+    # Loads the compiled catalog into this process before a fork-based pool starts, so the
+    # workers inherit it, and freezes it out of the collector; returns the catalog's
+    # lowercase setting.
+    global _worker_matcher
+    _worker_matcher, header = load_compiled_catalog(catalog_path, freeze=True)
+    preload_dependencies()
+    return header['lowercase']
+
+
+def _match_text(my_text, stats=None):
+    if _worker_lowercase:
+        my_text = my_text.lower()
+    return _worker_matcher.match(my_text, stats)
+
+
+def _check_chunk(chunk, collect_stats=False):
+    # Returns (results, stats); with collect_stats, stats is the chunk's CascadeStats for the
+    # parent to merge, otherwise None.
+    stats = CascadeStats() if collect_stats else None
+    return [(message_id, _match_text(my_text, stats)) for message_id, my_text in chunk], stats
+
+
+class _ResultWriter:
+    def __init__(self, output_path):
+        self.is_jsonl = output_path.endswith('.jsonl')
+        self.f = open(output_path, 'w', encoding='utf-8', newline='')
+        if not self.is_jsonl:
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(['message_id', 'brand'] + RESULT_FIELDS)
+
+    def write(self, message_id, my_brand, result_box):
+        if self.is_jsonl:
+            record = {'message_id': message_id, 'brand': my_brand}
+            record.update(result_box)
+            self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        else:
+            self.writer.writerow([message_id, my_brand] + [result_box[k] for k in RESULT_FIELDS])
+
+    def close(self):
+        self.f.close()
+
+
+def _write_chunk_results(writer, future, include_empty, stats):
+    chunk_results, chunk_stats = future.result()
+    if chunk_stats is not None:
+        stats.merge(chunk_stats)
+    for message_id, results in chunk_results:
+        for my_brand, result_box in results.items():
+            if include_empty or any(result_box.values()):
+                writer.write(message_id, my_brand, result_box)
+    return len(chunk_results)
+
+
+def check_impersonation_batch(input_path, output_path, brands, workers=None, chunk_size=64,
+                              max_pending=None, lowercase=True, include_empty=False,
+                              id_field='message_id', text_field='text', catalog_path=None, stats=None,
+                              segmentation_cache_path=None):
+    # Streams (message_id, text) rows through a process pool in chunks. At most max_pending
+    # chunks are in flight, and results are written in input order as soon as they are ready.
+    # With catalog_path, brands is ignored and the compiled catalog (and its lowercase
+    # setting) is used; it is loaded once here, before the workers fork. With stats, a
+    # CascadeStats, the workers count per chunk and the counts are merged into stats. With
+    # segmentation_cache_path, the workers' segmentation caches start from and are saved to
+    # that snapshot.
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    chunks = _chunked(iter_messages(input_path, id_field, text_field), chunk_size)
+
+    if catalog_path is not None:
+        lowercase = _load_worker_catalog(catalog_path)
+        brands = None
     else:
-        return check_impersonation_multiple_words(my_brand, brand_count, text_split_, my_text)
+        brands = list(brands)
+
+    message_count = 0
+    writer = _ResultWriter(output_path)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_match_worker,
+                                 initargs=(brands, lowercase, catalog_path, segmentation_cache_path)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_check_chunk, chunk, stats is not None))
+                if len(pending) >= max_pending:
+                    message_count += _write_chunk_results(writer, pending.popleft(), include_empty, stats)
+            while pending:
+                message_count += _write_chunk_results(writer, pending.popleft(), include_empty, stats)
+    finally:
+        writer.close()
+    return message_count
+
+
+def catalog_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compile a brand CSV into a catalog artifact.')
+    parser.add_argument('brands', help='brand CSV: a "brand" column (and optional "brand_id"), or one brand per row')
+    parser.add_argument('output', help='artifact path')
+    parser.add_argument('--column', default='brand')
+    parser.add_argument('--case-sensitive', action='store_true')
+    parser.add_argument('--substring-gate', action='store_true')
+    args = parser.parse_args(argv)
+
+    matcher = compile_catalog(list(load_brands(args.brands, args.column).values()), args.output,
+                              lowercase=not args.case_sensitive, substring_gate=args.substring_gate)
+    print(f"Compiled {len(matcher.brands):,} brands into {args.output}")
+
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        catalog_main(sys.argv[1:])
+        sys.exit(0)
+
     # ONE-WORD BRAND TESTS
     print("=" * 60)
     print("Test 1: Microsoft (one-word)")
@@ -0,0 +1,220 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+
+import impersonation_analysis as ia
+
+# INCREMENTAL RE-ANALYSIS
+#
+# A SQLite store of every message's text hash and token views, and of the non-empty result
+# box of every (message, brand) pair. When the catalog changes only added or respelled
+# brands are run over the stored views, and removed brands are dropped; new or edited
+# messages are run against the whole catalog. Pairs without a stored row had no hit.
+
+# Bump when a change to the detector alters result boxes without changing any of the
+# tables hashed in rules_version().
+DETECTOR_VERSION = 1
+
+PAGE_SIZE = 500
+
+
+def rules_version(lowercase):
+    # Stored views and results are only reused when the normalization tables, distance
+    # bounds and detector version they were made with are unchanged.
+    payload = json.dumps([DETECTOR_VERSION, lowercase, ia.INVISIBLE_PATTERNS, sorted(ia.CONFUSABLES.items()),
+                          ia.TYPO_DISTANCE, ia.FUZZY_DISTANCE], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def normalize_catalog(brands):
+    # A catalog is {brand_id: spelling}, or a list of spellings that are their own ids.
+    if isinstance(brands, dict):
+        return {str(brand_id): my_brand for brand_id, my_brand in brands.items()}
+    return {my_brand: my_brand for my_brand in brands}
+
+
+class IncrementalAnalyzer:
+    def __init__(self, path, lowercase=True):
+        self.lowercase = lowercase
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id TEXT PRIMARY KEY, text_hash TEXT NOT NULL, text TEXT NOT NULL, views TEXT);"
+            "CREATE TABLE IF NOT EXISTS brands ("
+            "brand_id TEXT PRIMARY KEY, brand TEXT NOT NULL, brand_hash TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS results ("
+            "message_id TEXT NOT NULL, brand_id TEXT NOT NULL, box TEXT NOT NULL, "
+            "PRIMARY KEY (message_id, brand_id));"
+            "CREATE INDEX IF NOT EXISTS results_brand ON results (brand_id);"
+        )
+        self._check_rules()
+
+    def _check_rules(self):
+        # After a rules change every view is rebuilt and the stored catalog is run again over
+        # every stored message, so no stored message loses its results.
+        version = rules_version(self.lowercase)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'rules_version'").fetchone()
+        changed = row is not None and row[0] != version
+        if changed:
+            self.conn.execute("DELETE FROM results")
+            self.conn.execute("UPDATE messages SET views = NULL")
+            self.conn.execute("UPDATE brands SET brand_hash = ''")
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rules_version', ?)", (version,))
+        self.conn.commit()
+        if changed:
+            self.update_catalog(self.catalog())
+
+    def _prepare(self, text):
+        return text.lower() if self.lowercase else text
+
+    def _matcher(self, catalog):
+        # The matcher works on spellings; several ids can share one.
+        ids_by_brand = {}
+        for brand_id, my_brand in catalog.items():
+            ids_by_brand.setdefault(self._prepare(my_brand), []).append(brand_id)
+        return ia.BrandMatcher(list(ids_by_brand)), ids_by_brand
+
+    def _store_results(self, message_id, results, ids_by_brand):
+        rows = [(message_id, brand_id, json.dumps(result_box))
+                for my_brand, result_box in results.items() if any(result_box.values())
+                for brand_id in ids_by_brand[my_brand]]
+        self.conn.executemany("INSERT OR REPLACE INTO results (message_id, brand_id, box) VALUES (?, ?, ?)", rows)
+
+    def catalog(self):
+        return dict(self.conn.execute("SELECT brand_id, brand FROM brands"))
+
+    def update_catalog(self, brands):
+        # Brings the store in line with brands; returns what changed.
+        catalog = normalize_catalog(brands)
+        stored = dict(self.conn.execute("SELECT brand_id, brand_hash FROM brands"))
+        hashes = {brand_id: content_hash(my_brand) for brand_id, my_brand in catalog.items()}
+
+        removed = [brand_id for brand_id in stored if brand_id not in catalog]
+        added = [brand_id for brand_id in catalog if brand_id not in stored]
+        modified = [brand_id for brand_id in catalog if brand_id in stored and stored[brand_id] != hashes[brand_id]]
+
+        changed = removed + modified
+        self.conn.executemany("DELETE FROM results WHERE brand_id = ?", [(brand_id,) for brand_id in changed])
+        self.conn.executemany("DELETE FROM brands WHERE brand_id = ?", [(brand_id,) for brand_id in removed])
+
+        pairs = 0
+        to_run = {brand_id: catalog[brand_id] for brand_id in added + modified}
+        if to_run:
+            matcher, ids_by_brand = self._matcher(to_run)
+            for message_id, text, views in self._iter_stored_messages():
+                self._store_results(message_id, matcher.match(self._prepare(text), views=views), ids_by_brand)
+                pairs += len(to_run)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO brands (brand_id, brand, brand_hash) VALUES (?, ?, ?)",
+            [(brand_id, my_brand, hashes[brand_id]) for brand_id, my_brand in to_run.items()]
+        )
+        self.conn.commit()
+        return {'brands_added': len(added), 'brands_modified': len(modified), 'brands_removed': len(removed),
+                'brands_unchanged': len(catalog) - len(added) - len(modified), 'pairs_evaluated': pairs}
+
+    def _iter_stored_messages(self):
+        # Pages through the messages by rowid, so rows can be written while iterating.
+        last_rowid = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT rowid, message_id, text, views FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, PAGE_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            for rowid, message_id, text, views_json in rows:
+                if views_json is None:
+                    views = ia.TokenViews(self._prepare(text).split())
+                    self.conn.execute("UPDATE messages SET views = ? WHERE rowid = ?",
+                                      (json.dumps(views.to_dict(), ensure_ascii=False), rowid))
+                else:
+                    views = ia.TokenViews.from_dict(json.loads(views_json))
+                yield message_id, text, views
+            last_rowid = rows[-1][0]
+            self.conn.commit()
+
+    def update_messages(self, messages):
+        # messages is an iterable of (message_id, text). New and edited messages are run
+        # against the stored catalog; unchanged ones are skipped.
+        matcher, ids_by_brand = self._matcher(self.catalog())
+        stats = {'messages_added': 0, 'messages_changed': 0, 'messages_unchanged': 0, 'pairs_evaluated': 0}
+        for count, (message_id, text) in enumerate(messages, 1):
+            text_hash = content_hash(text)
+            row = self.conn.execute("SELECT text_hash FROM messages WHERE message_id = ?", (message_id,)).fetchone()
+            if row is not None and row[0] == text_hash:
+                stats['messages_unchanged'] += 1
+                continue
+            stats['messages_added' if row is None else 'messages_changed'] += 1
+
+            views = ia.TokenViews(self._prepare(text).split())
+            self.conn.execute(
+                "INSERT OR REPLACE INTO messages (message_id, text_hash, text, views) VALUES (?, ?, ?, ?)",
+                (message_id, text_hash, text, json.dumps(views.to_dict(), ensure_ascii=False))
+            )
+            self.conn.execute("DELETE FROM results WHERE message_id = ?", (message_id,))
+            self._store_results(message_id, matcher.match(self._prepare(text), views=views), ids_by_brand)
+            stats['pairs_evaluated'] += sum(len(brand_ids) for brand_ids in ids_by_brand.values())
+            if count % PAGE_SIZE == 0:
+                self.conn.commit()
+        self.conn.commit()
+        return stats
+
+    def remove_messages(self, message_ids):
+        for message_id in message_ids:
+            self.conn.execute("DELETE FROM results WHERE message_id = ?", (message_id,))
+            self.conn.execute("DELETE FROM messages WHERE message_id = ?", (message_id,))
+        self.conn.commit()
+
+    def results(self, message_id=None):
+        # Yields (message_id, brand_id, brand, result_box) for every stored hit.
+        query = ("SELECT r.message_id, r.brand_id, b.brand, r.box FROM results r "
+                 "JOIN brands b ON b.brand_id = r.brand_id")
+        params = ()
+        if message_id is not None:
+            query += " WHERE r.message_id = ?"
+            params = (message_id,)
+        query += " ORDER BY r.message_id, r.brand_id"
+        for row_message_id, brand_id, my_brand, box in self.conn.execute(query, params):
+            yield row_message_id, brand_id, my_brand, json.loads(box)
+
+    def close(self):
+        self.conn.close()
+
+
+def incremental_main(argv):
+    parser = argparse.ArgumentParser(description='Keep brand impersonation results up to date incrementally.')
+    parser.add_argument('store', help='SQLite store path')
+    parser.add_argument('--brands', help='brand CSV: a "brand" column (and optional "brand_id"), or one brand per line')
+    parser.add_argument('--messages', help='CSV or .jsonl of messages to add or update')
+    parser.add_argument('--id-field', default='message_id')
+    parser.add_argument('--text-field', default='text')
+    parser.add_argument('--case-sensitive', action='store_true')
+    parser.add_argument('--export', help='write every stored hit to this .jsonl path')
+    args = parser.parse_args(argv)
+
+    analyzer = IncrementalAnalyzer(args.store, lowercase=not args.case_sensitive)
+    try:
+        if args.brands:
+            print(json.dumps(analyzer.update_catalog(ia.load_brands(args.brands))))
+        if args.messages:
+            messages = ia.iter_messages(args.messages, args.id_field, args.text_field)
+            print(json.dumps(analyzer.update_messages(messages)))
+        if args.export:
+            with open(args.export, 'w', encoding='utf-8') as out:
+                for message_id, brand_id, my_brand, result_box in analyzer.results():
+                    record = {'message_id': message_id, 'brand_id': brand_id, 'brand': my_brand}
+                    record.update(result_box)
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    finally:
+        analyzer.close()
+
+
+if __name__ == "__main__":
+    incremental_main(sys.argv[1:])
@@ -0,0 +1,58 @@
+import os
+
+# COUNTER SETS
+#
+# The stats objects the extraction and matching code fill in (ExtractionStats, CascadeStats)
+# hold nothing but counters: numbers, or {label: number} dicts. Pool workers send theirs
+# back with their results and the parent merges them, so one object covers the whole run.
+
+
+class CounterStats:
+    # NAMESPACE prefixes every exported metric. METRICS lists (attribute, metric name, help
+    # text), or (attribute, metric name, help text, label name) for a dict attribute.
+    # Attributes named in CALLBACKS are hooks, not counters.
+    NAMESPACE = 'stats'
+    METRICS = ()
+    CALLBACKS = ()
+
+    def counters(self):
+        return {name: value for name, value in vars(self).items() if name not in self.CALLBACKS}
+
+    def merge(self, other):
+        # For adding up the stats of several workers.
+        for name, value in other.counters().items():
+            if isinstance(value, dict):
+                mine = getattr(self, name)
+                for label, count in value.items():
+                    mine[label] = mine.get(label, 0) + count
+            else:
+                setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def as_dict(self):
+        return {name: dict(value) if isinstance(value, dict) else value for name, value in self.counters().items()}
+
+    def to_prometheus(self, namespace=None):
+        # Prometheus text exposition format; every metric is a counter. Label values lose a
+        # trailing underscore, so the stage prefix 'raw_' is exported as stage="raw".
+        namespace = namespace or self.NAMESPACE
+        lines = []
+        for attribute, name, help_text, *label in self.METRICS:
+            metric = f'{namespace}_{name}'
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+            value = getattr(self, attribute)
+            if label:
+                lines += [f'{metric}{{{label[0]}="{str(key).rstrip("_")}"}} {count}' for key, count in value.items()]
+            else:
+                lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, *stats):
+    # For a node_exporter textfile collector: the file is replaced in one step, so a scrape
+    # never reads half of it.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for counter_stats in stats:
+            f.write(counter_stats.to_prometheus())
+    os.replace(tmp_path, path)
@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import extract_contents_forwarded_as_attachements as extraction
+import impersonation_analysis as impersonation
+from metrics import write_prometheus
+
+# STAGES
+#
+# source -> [extract: process pool] -> [match: process pool] -> [llm: async] -> writer
+#
+# Every stage reads from a bounded asyncio.Queue and blocks on put() when the next stage
+# falls behind, so memory stays bounded no matter how large the source is. Records are
+# written in completion order.
+
+LLM_MODES = ('off', 'flagged', 'all')
+
+_DONE = object()
+
+
+def _match_one(my_text, collect_stats=False):
+    # Runs in a pool set up by impersonation._init_match_worker; only brands with at least
+    # one hit are kept. Returns (hits, stats) like impersonation._check_chunk.
+    stats = impersonation.CascadeStats() if collect_stats else None
+    results = impersonation._match_text(my_text, stats)
+    return {my_brand: result_box for my_brand, result_box in results.items() if any(result_box.values())}, stats
+
+
+async def _run_stage(worker_count, inbox, outbox, handle):
+    # worker_count coroutines share the inbox; the _DONE marker is put back for the siblings
+    # and passed on once all of them have stopped.
+    async def worker():
+        while True:
+            record = await inbox.get()
+            if record is _DONE:
+                await inbox.put(_DONE)
+                return
+            await outbox.put(await handle(record))
+
+    await asyncio.gather(*(worker() for _ in range(worker_count)))
+    await outbox.put(_DONE)
+
+
+async def _feed(items, outbox):
+    for item in items:
+        await outbox.put(item)
+    await outbox.put(_DONE)
+
+
+class _RecordWriter:
+    # JSONL by default; a .parquet output path needs pyarrow. Parquet has no free-form nested
+    # columns, so the per-brand results and the label are stored as JSON strings there.
+    NESTED_FIELDS = ('impersonation', 'label')
+
+    def __init__(self, output_path, row_group_size=1000):
+        self.is_parquet = output_path.endswith('.parquet')
+        self.output_path = output_path
+        self.row_group_size = row_group_size
+        if self.is_parquet:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("Parquet output needs pyarrow; write to a .jsonl path instead") from None
+            self.pa = pyarrow
+            self.pq = pyarrow.parquet
+            self.parquet_writer = None
+            self.rows = []
+        else:
+            self.f = open(output_path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        if not self.is_parquet:
+            self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            return
+        row = dict(record)
+        for field in self.NESTED_FIELDS:
+            if row.get(field) is not None:
+                row[field] = json.dumps(row[field], ensure_ascii=False)
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        schema = self.pa.schema([
+            ('message_id', self.pa.string()),
+            ('content', self.pa.string()),
+            ('error', self.pa.string()),
+            ('impersonation', self.pa.string()),
+            ('llm_response', self.pa.string()),
+            ('label', self.pa.string()),
+            ('llm_error', self.pa.string()),
+            ('input_tokens', self.pa.int64()),
+            ('output_tokens', self.pa.int64()),
+        ])
+        table = self.pa.Table.from_pylist(self.rows, schema=schema)
+        if self.parquet_writer is None:
+            self.parquet_writer = self.pq.ParquetWriter(self.output_path, schema)
+        self.parquet_writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if not self.is_parquet:
+            self.f.close()
+            return
+        self._flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+async def run_pipeline_async(source, output_path, brands, extension='.eml', llm='off',
+                             extract_workers=None, match_workers=None, llm_concurrency=8,
+                             queue_size=None, timeout=None, backend='bs4', lowercase=True,
+                             keep_content=False, max_body_tokens=None, cache=None, normalize_key=False,
+                             async_client=None, api_key=None, base_url=None, text_cache_path=None,
+                             catalog_path=None, extraction_stats=None, cascade_stats=None,
+                             segmentation_cache_path=None):
+    # Writes one record per message:
+    #   message_id, error          extraction result ('parse_failed', 'timeout' or None)
+    #   impersonation              {brand: result_box} for brands with a hit
+    #   llm_response, label        when the message was sent to the LLM (llm='all', or
+    #   llm_error, *_tokens        llm='flagged' and some brand was hit)
+    #   content                    the extracted text, with keep_content=True
+    # With text_cache_path, the extract workers share a VisibleTextCache there, and its hit
+    # counts for this run are added to the returned stats. With catalog_path, brands is
+    # ignored and the compiled catalog (and its lowercase setting) is used; it is loaded
+    # once here, before the match workers fork. extraction_stats (an ExtractionStats) and
+    # cascade_stats (a CascadeStats), if given, get the merged counts of the workers. With
+    # segmentation_cache_path, the match workers' segmentation caches start from and are
+    # saved to that snapshot.
+    if llm not in LLM_MODES:
+        raise ValueError(f"Unknown llm mode {llm!r}; expected one of {', '.join(LLM_MODES)}")
+
+    cpu_count = os.cpu_count() or 1
+    extract_workers = extract_workers or cpu_count
+    match_workers = match_workers or cpu_count
+    queue_size = queue_size or 4 * max(extract_workers, match_workers, llm_concurrency)
+
+    if llm != 'off':
+        # Imported here so the extraction and matching stages work without openai/tiktoken.
+        import prompt_example
+        if async_client is None:
+            async_client = prompt_example.AsyncOpenAI(api_key=api_key or prompt_example.key or None,
+                                                      base_url=base_url or prompt_example.BASE_URL,
+                                                      max_retries=0)
+        semaphore = asyncio.Semaphore(llm_concurrency)
+        in_flight = {}
+
+    loop = asyncio.get_running_loop()
+    stats = {'messages': 0, 'extract_failed': 0, 'flagged': 0, 'llm_completed': 0, 'llm_failed': 0,
+             'llm_cached': 0}
+
+    async def extract(item):
+        message_id, content, error, item_stats = await loop.run_in_executor(
+            extract_pool, extraction._extract_one, item, extraction_stats is not None
+        )
+        if item_stats is not None:
+            extraction_stats.merge(item_stats)
+        return {'message_id': message_id, 'content': content, 'error': error}
+
+    async def match(record):
+        record['impersonation'] = {}
+        if record['content'] is not None:
+            record['impersonation'], item_stats = await loop.run_in_executor(
+                match_pool, _match_one, record['content'], cascade_stats is not None
+            )
+            if item_stats is not None:
+                cascade_stats.merge(item_stats)
+        return record
+
+    async def classify(record):
+        if record['impersonation']:
+            stats['flagged'] += 1
+        if record['content'] is None or llm == 'off' or (llm == 'flagged' and not record['impersonation']):
+            return record
+
+        try:
+            result = await prompt_example.classify_email_async(record['content'], async_client, semaphore, cache,
+                                                               normalize_key, max_body_tokens, in_flight)
+        except Exception as error:
+            record['llm_error'] = f"{type(error).__name__}: {error}"
+            stats['llm_failed'] += 1
+            return record
+
+        record['llm_response'] = result['response']
+        record['label'] = prompt_example.parse_label(result['response'])
+        if result.get('cached'):
+            stats['llm_cached'] += 1
+        else:
+            record['input_tokens'] = result['input_tokens']
+            record['output_tokens'] = result['output_tokens']
+            stats['llm_completed'] += 1
+        return record
+
+    async def write(inbox, writer):
+        while True:
+            record = await inbox.get()
+            if record is _DONE:
+                return
+            stats['messages'] += 1
+            if record['error'] is not None:
+                stats['extract_failed'] += 1
+            if not keep_content:
+                del record['content']
+            writer.write(record)
+
+    sources = asyncio.Queue(queue_size)
+    extracted = asyncio.Queue(queue_size)
+    matched = asyncio.Queue(queue_size)
+    classified = asyncio.Queue(queue_size)
+
+    text_cache = since = None
+    if text_cache_path is not None:
+        text_cache = extraction.VisibleTextCache(text_cache_path)
+        since = text_cache.shared_counts()
+
+    if catalog_path is not None:
+        lowercase = impersonation._load_worker_catalog(catalog_path)
+        brands = None
+    else:
+        brands = list(brands)
+
+    writer = _RecordWriter(output_path)
+    extract_pool = ProcessPoolExecutor(max_workers=extract_workers, initializer=extraction._init_extraction_worker,
+                                       initargs=(timeout, backend, text_cache_path))
+    match_pool = ProcessPoolExecutor(max_workers=match_workers, initializer=impersonation._init_match_worker,
+                                     initargs=(brands, lowercase, catalog_path, segmentation_cache_path))
+    try:
+        # Twice as many coroutines as processes, so a pool never waits on the event loop.
+        await asyncio.gather(
+            _feed(extraction.iter_extraction_items(source, extension), sources),
+            _run_stage(2 * extract_workers, sources, extracted, extract),
+            _run_stage(2 * match_workers, extracted, matched, match),
+            _run_stage(llm_concurrency * 2 if llm != 'off' else 1, matched, classified, classify),
+            write(classified, writer),
+        )
+    finally:
+        extract_pool.shutdown(cancel_futures=True)
+        match_pool.shutdown(cancel_futures=True)
+        writer.close()
+    if text_cache is not None:
+        # The workers have written their counts by now: shutdown() waits for them to exit.
+        stats['text_cache'] = text_cache.shared_stats(since)
+        text_cache.close()
+    return stats
+
+
+def run_pipeline(source, output_path, brands, **kwargs):
+    return asyncio.run(run_pipeline_async(source, output_path, brands, **kwargs))
+
+
+def pipeline_main(argv):
+    parser = argparse.ArgumentParser(description='Extract visible text, match brands and label emails with an LLM.')
+    parser.add_argument('source', help='.eml file, directory of .eml files, maildir or mbox file')
+    parser.add_argument('-o', '--output', required=True, help='.jsonl or .parquet output path')
+    catalog = parser.add_mutually_exclusive_group(required=True)
+    catalog.add_argument('--brands', help='brand CSV: a "brand" column, or one brand per line')
+    catalog.add_argument('--catalog', help='compiled brand catalog, see impersonation_analysis.py')
+    parser.add_argument('--extension', default='.eml')
+    parser.add_argument('--llm', choices=LLM_MODES, default='off',
+                        help="send no, only brand-flagged, or all messages to the LLM")
+    parser.add_argument('--extract-workers', type=int, default=None)
+    parser.add_argument('--match-workers', type=int, default=None)
+    parser.add_argument('--llm-concurrency', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None, help='per-file extraction timeout in seconds')
+    parser.add_argument('--backend', choices=sorted(extraction.TEXT_BACKENDS), default='bs4')
+    parser.add_argument('--case-sensitive', action='store_true')
+    parser.add_argument('--keep-content', action='store_true', help='include the extracted text in the output')
+    parser.add_argument('--max-body-tokens', type=int, default=None)
+    parser.add_argument('--cache', help='SQLite response cache path')
+    parser.add_argument('--text-cache', help='SQLite visible-text cache path, shared by the extract workers')
+    parser.add_argument('--segmentation-cache',
+                        help='JSON snapshot of the word segmentation cache, loaded by the match workers and saved on exit')
+    parser.add_argument('--metrics', help='write the extraction and cascade counters here, in Prometheus text format')
+    args = parser.parse_args(argv)
+
+    extraction_stats = cascade_stats = None
+    if args.metrics:
+        extraction_stats = extraction.ExtractionStats()
+        cascade_stats = impersonation.CascadeStats()
+
+    brands = list(impersonation.load_brands(args.brands).values()) if args.brands else None
+    cache = None
+    if args.cache:
+        import prompt_example
+        cache = prompt_example.ResponseCache(args.cache)
+    try:
+        stats = run_pipeline(args.source, args.output, brands, extension=args.extension,
+                             llm=args.llm, extract_workers=args.extract_workers, match_workers=args.match_workers,
+                             llm_concurrency=args.llm_concurrency, queue_size=args.queue_size, timeout=args.timeout,
+                             backend=args.backend, lowercase=not args.case_sensitive, keep_content=args.keep_content,
+                             max_body_tokens=args.max_body_tokens, cache=cache, text_cache_path=args.text_cache,
+                             catalog_path=args.catalog, extraction_stats=extraction_stats,
+                             cascade_stats=cascade_stats, segmentation_cache_path=args.segmentation_cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    if args.metrics:
+        write_prometheus(args.metrics, extraction_stats, cascade_stats)
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    pipeline_main(sys.argv[1:])
@@ -1,26 +1,61 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, APIStatusError
 import tiktoken
+import asyncio
+import json
+import os
+import random
+import re
+import hashlib
+import sqlite3
+import time
 
 key = ""  # input your key
-client = OpenAI(api_key=key, base_url="https://us.api.openai.com/v1")
-encoding = tiktoken.get_encoding("o200k_base")
+BASE_URL = "https://us.api.openai.com/v1"
+MODEL = "gpt-5.1"
 
 token_stats = {
     'total_input_tokens': 0,
-    'total_output_tokens': 0
+    'total_output_tokens': 0,
+    'cache_hits': 0,
+    'cache_misses': 0
 }
 
+_client = None
+
+def get_client():
+    # Made on first use, like the AsyncOpenAI client, so importing this module needs no key.
+    # An empty key falls back to the OPENAI_API_KEY environment variable.
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=key or None, base_url=BASE_URL)
+    return _client
+
+_encoding = None
+
+def get_encoding():
+    # Loaded on first use: tiktoken downloads the BPE file the first time it is asked for it,
+    # and emails only need tokenizing to cut them or when a response carries no usage.
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    return _encoding
+
 def count_tokens(text):
-    return len(encoding.encode(text))
+    return len(get_encoding().encode(text))
+
+# The Batch API bills input and output tokens at half the interactive price.
+BATCH_PRICE_FACTOR = 0.5
 
-def calculate_cost(input_tokens, output_tokens):
+def calculate_cost(input_tokens, output_tokens, batch=False):
     input_cost = (input_tokens / 1_000_000) * 1.250
     output_cost = (output_tokens / 1_000_000) * 10.000
+    if batch:
+        input_cost *= BATCH_PRICE_FACTOR
+        output_cost *= BATCH_PRICE_FACTOR
     total_cost = input_cost + output_cost
     return input_cost, output_cost, total_cost
 
-def analyze_email(email_content):
-    system_content = """You are an expert at analyzing phishing emails.
+SYSTEM_CONTENT = """You are an expert at analyzing phishing emails.
 
     CRITICAL RULES:
     1. Analyze ONLY the original email.
@@ -30,7 +65,7 @@ def analyze_email(email_content):
        Exception: For Question 2, select the 'Multiple actions' option ONLY if the email offers distinct ALTERNATIVE methods to execute the scam (e.g., Call OR Click). IGNORE administrative footer links (unsubscribe, privacy policy).
     """
 
-    user_content = f"""Analyze this phishing email and answer two questions:
+USER_CONTENT_TEMPLATE = """Analyze this phishing email and answer two questions:
 
 1. (Type) What type of content does the email contain?
    1) Account Security / Credential Alert
@@ -65,36 +100,194 @@ def analyze_email(email_content):
    7) None (Informational only, no action requested)
 
 Return ONLY a JSON object in this exact format:
-{{
+{
   "Type": <number>,
   "Action": <number>,
   "detail": "<optional: only if Action is 6>"
-}}
+}
 
 Email:
 {email_content}
 """
+
+def build_messages(email_content):
+    return [
+        {
+            "role": "system", 
+            "content": SYSTEM_CONTENT
+        },
+        {
+            "role": "user", 
+            "content": USER_CONTENT_TEMPLATE.replace("{email_content}", email_content)
+        }
+    ]
+
+# TOKEN ACCOUNTING
+
+# The system prompt and the template around the email body are the same for every email,
+# so they are encoded once; per email only the body is encoded. Token counts are summed
+# per part, which can differ by a token or two from encoding the joined prompt; the API's
+# usage numbers are used whenever a response carries them.
+_PROMPT_PREFIX, _PROMPT_SUFFIX = USER_CONTENT_TEMPLATE.split("{email_content}")
+_static_prompt_tokens = None
+
+def static_prompt_tokens():
+    global _static_prompt_tokens
+    if _static_prompt_tokens is None:
+        _static_prompt_tokens = (count_tokens(SYSTEM_CONTENT) + count_tokens(_PROMPT_PREFIX)
+                                 + count_tokens(_PROMPT_SUFFIX))
+    return _static_prompt_tokens
+
+def prepare_email_body(email_content, max_body_tokens=None):
+    # Returns (body, body_tokens). Bodies over max_body_tokens are cut at a token boundary;
+    # without a limit the body is not tokenized and body_tokens is None.
+    if max_body_tokens is None:
+        return email_content, None
+    encoding = get_encoding()
+    tokens = encoding.encode(email_content, disallowed_special=())
+    if len(tokens) > max_body_tokens:
+        tokens = tokens[:max_body_tokens]
+        # A cut inside a multi-byte character decodes to a replacement character.
+        email_content = encoding.decode(tokens).rstrip('\ufffd')
+    return email_content, len(tokens)
+
+def response_token_counts(response, email_content, response_text, body_tokens=None):
+    # The API's usage numbers, or local estimates when the response carries none.
+    usage = getattr(response, 'usage', None)
+    if usage is not None and usage.prompt_tokens is not None and usage.completion_tokens is not None:
+        return usage.prompt_tokens, usage.completion_tokens
+    if body_tokens is None:
+        body_tokens = count_tokens(email_content)
+    return static_prompt_tokens() + body_tokens, count_tokens(response_text)
+
+# RESPONSE CACHE
+
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_email_for_cache(email_content):
+    # Campaign duplicates differ mostly in tracking URLs and whitespace.
+    text = _URL_RE.sub('<url>', email_content)
+    return _WHITESPACE_RE.sub(' ', text).strip()
+
+class ResponseCache:
+    # Persistent SQLite cache of model answers keyed by a hash of (model, system prompt,
+    # user prompt). Entries beyond max_entries are evicted least recently used first.
+    # The last_used updates of hits are held in memory and written TOUCH_BATCH at a time, with
+    # the next put, or on close.
+    TOUCH_BATCH = 100
+    
+    def __init__(self, path, max_entries=100_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.pending_touches = {}
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "input_tokens INTEGER, output_tokens INTEGER, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        # Counted once here and kept up to date by put, so inserts need no COUNT(*).
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    
+    @staticmethod
+    def make_key(model, system_content, user_content):
+        payload = json.dumps([model, system_content, user_content], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT response, input_tokens, output_tokens FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            token_stats['cache_misses'] += 1
+            return None
+        self.hits += 1
+        token_stats['cache_hits'] += 1
+        self.pending_touches[key] = time.time()
+        if len(self.pending_touches) >= self.TOUCH_BATCH:
+            self._write_touches()
+            self.conn.commit()
+        return {'response': row[0], 'input_tokens': row[1], 'output_tokens': row[2]}
+    
+    def _write_touches(self):
+        if self.pending_touches:
+            self.conn.executemany(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self.pending_touches.items()]
+            )
+            self.pending_touches.clear()
+    
+    def put(self, key, response_text, input_tokens, output_tokens):
+        # Recent hits are written first, so eviction does not pick entries that were just used.
+        self._write_touches()
+        row = (response_text, input_tokens, output_tokens, time.time(), key)
+        if self.conn.execute(
+            "UPDATE responses SET response = ?, input_tokens = ?, output_tokens = ?, last_used = ? "
+            "WHERE key = ?", row
+        ).rowcount == 0:
+            self.conn.execute(
+                "INSERT INTO responses (response, input_tokens, output_tokens, last_used, key) "
+                "VALUES (?, ?, ?, ?, ?)", row
+            )
+            self.entries += 1
+        excess = self.entries - self.max_entries
+        if excess > 0:
+            self.entries -= self.conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,)
+            ).rowcount
+        self.conn.commit()
+    
+    def size(self):
+        return self.entries
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'size': self.size(),
+            'max_entries': self.max_entries,
+        }
+    
+    def close(self):
+        self._write_touches()
+        self.conn.commit()
+        self.conn.close()
+
+def cache_key_for(email_content, normalize_key=False):
+    if normalize_key:
+        email_content = normalize_email_for_cache(email_content)
+    messages = build_messages(email_content)
+    return ResponseCache.make_key(MODEL, messages[0]["content"], messages[1]["content"])
+
+def analyze_email(email_content, cache=None, normalize_key=False, max_body_tokens=None):
+    email_content, body_tokens = prepare_email_body(email_content, max_body_tokens)
+    messages = build_messages(email_content)
+    
+    if cache is not None:
+        cache_key = cache_key_for(email_content, normalize_key)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print(f"Cache hit, Response: {cached['response']}")
+            return cached['response']
     
-    input_tokens = count_tokens(system_content) + count_tokens(user_content)
-    token_stats['total_input_tokens'] += input_tokens
         
-    response = client.chat.completions.create(
-        model="gpt-5.1",
-        messages=[
-            {
-                "role": "system", 
-                "content": system_content
-            },
-            {
-                "role": "user", 
-                "content": user_content
-            }
-        ]
+    response = get_client().chat.completions.create(
+        model=MODEL,
+        messages=messages
     )
 
     response_text = response.choices[0].message.content.strip()
-    output_tokens = count_tokens(response_text)
+    input_tokens, output_tokens = response_token_counts(response, email_content, response_text, body_tokens)
     
+    token_stats['total_input_tokens'] += input_tokens
     token_stats['total_output_tokens'] += output_tokens
     
     print(f"Input tokens: {input_tokens:,}, Output tokens: {output_tokens:,}")
@@ -103,8 +296,294 @@ Email:
     input_cost, output_cost, total_cost = calculate_cost(input_tokens, output_tokens)
     print(f"Input cost: ${input_cost:.4f}, Output cost: ${output_cost:.4f}, Total cost: ${total_cost:.4f}")
     
+    if cache is not None:
+        cache.put(cache_key, response_text, input_tokens, output_tokens)
+    
     return response_text
 
+# ASYNC BATCH CLASSIFICATION
+
+def is_retryable_error(error):
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+async def create_with_retry(async_client, messages, semaphore, max_retries=5, base_delay=1.0, max_delay=60.0):
+    # Rate-limit, connection and 5xx errors are retried with "full jitter" exponential backoff;
+    # the semaphore is only held while a request is actually in flight.
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                return await async_client.chat.completions.create(model=MODEL, messages=messages)
+        except Exception as error:
+            if attempt == max_retries or not is_retryable_error(error):
+                raise
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+async def classify_email_async(email_content, async_client, semaphore, cache=None, normalize_key=False,
+                               max_body_tokens=None, in_flight=None, max_retries=5, base_delay=1.0,
+                               max_delay=60.0):
+    # Returns {'response', 'cached': True} on a cache hit, else {'response', 'input_tokens',
+    # 'output_tokens'}; errors are raised once create_with_retry gives up. in_flight maps the
+    # cache keys currently being classified to futures, so campaign duplicates that arrive
+    # meanwhile wait for the first copy's answer instead of sending their own request.
+    email_content, body_tokens = prepare_email_body(email_content, max_body_tokens)
+    cache_key = None
+    if cache is not None:
+        cache_key = cache_key_for(email_content, normalize_key)
+        while in_flight is not None and cache_key in in_flight:
+            await asyncio.wait([in_flight[cache_key]])
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return {'response': cached['response'], 'cached': True}
+        if in_flight is not None:
+            in_flight[cache_key] = asyncio.get_running_loop().create_future()
+    
+    messages = build_messages(email_content)
+    try:
+        response = await create_with_retry(async_client, messages, semaphore, max_retries, base_delay, max_delay)
+        response_text = response.choices[0].message.content.strip()
+        input_tokens, output_tokens = response_token_counts(response, email_content, response_text, body_tokens)
+        token_stats['total_input_tokens'] += input_tokens
+        token_stats['total_output_tokens'] += output_tokens
+        if cache is not None:
+            cache.put(cache_key, response_text, input_tokens, output_tokens)
+    finally:
+        if cache_key is not None and in_flight is not None:
+            in_flight.pop(cache_key).set_result(None)
+    return {'response': response_text, 'input_tokens': input_tokens, 'output_tokens': output_tokens}
+
+def load_checkpoint(output_path):
+    # message_ids that already have a successful result; failed ones are tried again.
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash.
+                continue
+            if 'error' not in record:
+                done.add(record['message_id'])
+    return done
+
+def drop_partial_line(output_path):
+    # A crash can leave the last record without its newline; it is cut off, so the records a
+    # rerun appends start on a line of their own. load_checkpoint skips such a line anyway.
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # Walk back to the last newline in blocks, so a large file is not read whole.
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            position = f.read(end - start).rfind(b'\n')
+            if position != -1:
+                f.truncate(start + position + 1)
+                return
+            end = start
+        f.truncate(0)
+
+async def classify_emails_async(emails, output_path, concurrency=8, max_retries=5, base_delay=1.0,
+                                max_delay=60.0, async_client=None, api_key=None, base_url=None,
+                                cache=None, normalize_key=False, max_body_tokens=None):
+    # emails is an iterable of (message_id, email_content). Results are appended to the JSONL
+    # output as they complete, so a rerun with the same output_path skips finished emails.
+    if async_client is None:
+        # The SDK's own retries are disabled so create_with_retry is the only retry policy.
+        async_client = AsyncOpenAI(api_key=api_key or key or None, base_url=base_url or BASE_URL, max_retries=0)
+    
+    drop_partial_line(output_path)
+    done = load_checkpoint(output_path)
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {'completed': 0, 'failed': 0, 'skipped': 0, 'cached': 0}
+    
+    in_flight = {}
+    
+    async def classify_one(message_id, email_content, out):
+        try:
+            result = await classify_email_async(email_content, async_client, semaphore, cache, normalize_key,
+                                                max_body_tokens, in_flight, max_retries, base_delay, max_delay)
+        except Exception as error:
+            record = {'message_id': message_id, 'error': f"{type(error).__name__}: {error}"}
+            stats['failed'] += 1
+        else:
+            record = {'message_id': message_id}
+            record.update(result)
+            stats['cached' if result.get('cached') else 'completed'] += 1
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+    
+    with open(output_path, 'a', encoding='utf-8') as out:
+        # Only a bounded number of tasks exist at a time, so the corpus is never held in memory.
+        pending = set()
+        for message_id, email_content in emails:
+            if message_id in done:
+                stats['skipped'] += 1
+                continue
+            pending.add(asyncio.ensure_future(classify_one(message_id, email_content, out)))
+            if len(pending) >= concurrency * 2:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if pending:
+            await asyncio.wait(pending)
+    
+    return stats
+
+def classify_emails(emails, output_path, **kwargs):
+    return asyncio.run(classify_emails_async(emails, output_path, **kwargs))
+
+# BATCH API MODE
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+def batch_custom_id(message_id):
+    # Stable across reruns, and within the 64 characters the Batch API accepts.
+    return "email-" + hashlib.sha256(str(message_id).encode('utf-8')).hexdigest()[:32]
+
+def write_batch_file(emails, batch_path, max_body_tokens=None):
+    # Returns {custom_id: message_id} for joining the results back. The Batch API rejects a
+    # file with repeated custom_ids, so only the first email with a given message_id is sent.
+    id_map = {}
+    duplicates = 0
+    with open(batch_path, 'w', encoding='utf-8') as f:
+        for message_id, email_content in emails:
+            custom_id = batch_custom_id(message_id)
+            if custom_id in id_map:
+                duplicates += 1
+                continue
+            id_map[custom_id] = message_id
+            email_content, _ = prepare_email_body(email_content, max_body_tokens)
+            request = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {"model": MODEL, "messages": build_messages(email_content)},
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + '\n')
+    if duplicates:
+        print(f"Skipped {duplicates:,} emails with a message_id already in the batch")
+    return id_map
+
+def submit_batch(batch_path, batch_client=None, completion_window="24h"):
+    batch_client = batch_client or get_client()
+    with open(batch_path, 'rb') as f:
+        batch_file = batch_client.files.create(file=f, purpose="batch")
+    batch = batch_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=completion_window
+    )
+    return batch.id
+
+def wait_for_batch(batch_id, batch_client=None, poll_interval=60.0, timeout=None):
+    batch_client = batch_client or get_client()
+    started = time.monotonic()
+    while True:
+        batch = batch_client.batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            return batch
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f"Batch {batch_id} still {batch.status} after {timeout}s")
+        time.sleep(poll_interval)
+
+def parse_label(response_text):
+    # The prompt asks for bare JSON, but tolerate a Markdown fence around it.
+    text = response_text.strip()
+    if text.startswith('```'):
+        text = text.strip('`')
+        if text.lower().startswith('json'):
+            text = text[4:]
+    try:
+        label = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(label, dict):
+        return None
+    return {'Type': label.get('Type'), 'Action': label.get('Action'), 'detail': label.get('detail', '')}
+
+def _read_file_lines(batch_client, file_id):
+    if not file_id:
+        return []
+    content = batch_client.files.content(file_id).text
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+def collect_batch_results(batch, id_map, batch_client=None):
+    # Yields one record per email; requests missing from both the output and error files
+    # (e.g. an expired batch) are reported as errors too.
+    batch_client = batch_client or get_client()
+    seen = set()
+    
+    for line in _read_file_lines(batch_client, batch.output_file_id):
+        custom_id = line['custom_id']
+        seen.add(custom_id)
+        response = line.get('response') or {}
+        body = response.get('body') or {}
+        if response.get('status_code') != 200 or not body.get('choices'):
+            yield {'message_id': id_map.get(custom_id), 'custom_id': custom_id, 'error': line.get('error') or body}
+            continue
+        response_text = body['choices'][0]['message']['content'].strip()
+        usage = body.get('usage') or {}
+        record = {
+            'message_id': id_map.get(custom_id),
+            'custom_id': custom_id,
+            'response': response_text,
+            'label': parse_label(response_text),
+            'input_tokens': usage.get('prompt_tokens', 0),
+            'output_tokens': usage.get('completion_tokens', 0),
+        }
+        yield record
+    
+    for line in _read_file_lines(batch_client, getattr(batch, 'error_file_id', None)):
+        custom_id = line['custom_id']
+        seen.add(custom_id)
+        yield {'message_id': id_map.get(custom_id), 'custom_id': custom_id, 'error': line.get('error') or line.get('response')}
+    
+    for custom_id, message_id in id_map.items():
+        if custom_id not in seen:
+            yield {'message_id': message_id, 'custom_id': custom_id, 'error': f"no result (batch {batch.status})"}
+
+def run_batch(emails, batch_path, results_path, batch_client=None, poll_interval=60.0, timeout=None,
+              max_body_tokens=None):
+    batch_client = batch_client or get_client()
+    id_map = write_batch_file(emails, batch_path, max_body_tokens)
+    batch_id = submit_batch(batch_path, batch_client)
+    print(f"Submitted batch {batch_id} with {len(id_map):,} emails")
+    
+    batch = wait_for_batch(batch_id, batch_client, poll_interval, timeout)
+    print(f"Batch {batch_id} finished with status {batch.status}")
+    
+    input_tokens = 0
+    output_tokens = 0
+    failed = 0
+    with open(results_path, 'w', encoding='utf-8') as out:
+        for record in collect_batch_results(batch, id_map, batch_client):
+            if 'error' in record:
+                failed += 1
+            else:
+                input_tokens += record['input_tokens']
+                output_tokens += record['output_tokens']
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    
+    token_stats['total_input_tokens'] += input_tokens
+    token_stats['total_output_tokens'] += output_tokens
+    
+    input_cost, output_cost, total_cost = calculate_cost(input_tokens, output_tokens, batch=True)
+    print(f"Input tokens: {input_tokens:,}, Output tokens: {output_tokens:,}, Failed: {failed:,}")
+    print(f"Input cost: ${input_cost:.4f}, Output cost: ${output_cost:.4f}, Total cost: ${total_cost:.4f} (batch pricing)")
+    
+    return {'batch_id': batch_id, 'status': batch.status, 'emails': len(id_map), 'failed': failed,
+            'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_cost': total_cost}
+
 if __name__ == "__main__":
     email_content = """
     Subject: Urgent: Your Account Has Been Suspended
@@ -124,3 +603,4 @@ if __name__ == "__main__":
     print(f"\n=== Total Statistics ===")
     print(f"Total input tokens: {token_stats['total_input_tokens']:,}")
     print(f"Total output tokens: {token_stats['total_output_tokens']:,}")
+    print(f"Cache hits: {token_stats['cache_hits']:,}, Cache misses: {token_stats['cache_misses']:,}")
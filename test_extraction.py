@@ -0,0 +1,35 @@
+import random
+import unittest
+
+import benchmark_extraction as bench
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+class PruneInvisibleTest(unittest.TestCase):
+    def test_matches_the_reference_on_random_markup(self):
+        rng = random.Random(0)
+        documents = [bench.make_random_document(rng) for _ in range(300)]
+        self.assertEqual(bench.check_reference(documents), [])
+
+    def test_matches_the_reference_on_newsletters(self):
+        self.assertEqual(bench.check_reference(bench.make_corpus(5, 20, 8)), [])
+
+
+@unittest.skipIf(lxml is None, 'lxml is not installed')
+class BackendEquivalenceTest(unittest.TestCase):
+    def test_backends_agree_on_well_formed_markup(self):
+        rng = random.Random(0)
+        documents = [bench.make_well_formed_document(rng) for _ in range(300)]
+        documents += bench.make_corpus(5, 20, 8)
+        self.assertEqual(bench.check_backends(documents), [])
+
+    def test_known_divergences_on_repaired_markup(self):
+        self.assertEqual(bench.check_known_divergences(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
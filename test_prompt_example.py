@@ -0,0 +1,288 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import prompt_example
+
+# A local stand-in for the chat completions endpoint. An email body containing RATE_LIMIT
+# gets two 429s before it is answered; one containing SERVER_ERROR gets a 500 for as long as
+# MockServer.failing is set.
+
+ANSWER = '{"Type": 1, "Action": 1, "detail": ""}'
+
+
+class MockServer(BaseHTTPRequestHandler):
+    calls = {}
+    failing = True
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        email_content = body['messages'][1]['content']
+        with self.lock:
+            attempt = self.calls.get(email_content, 0)
+            self.calls[email_content] = attempt + 1
+        if 'RATE_LIMIT' in email_content and attempt < 2:
+            return self._send(429, {'error': {'message': 'rate limited'}})
+        if 'SERVER_ERROR' in email_content and self.failing:
+            return self._send(500, {'error': {'message': 'server error'}})
+        self._send(200, {
+            'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': ANSWER}}],
+            'usage': {'prompt_tokens': 100, 'completion_tokens': 10, 'total_tokens': 110},
+        })
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ClassifyEmailsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}/v1'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        MockServer.calls = {}
+        MockServer.failing = True
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output_path = os.path.join(self.tmp.name, 'results.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def classify(self, emails, **kwargs):
+        return prompt_example.classify_emails(emails, self.output_path, api_key='test', base_url=self.base_url,
+                                              base_delay=0.001, max_retries=2, **kwargs)
+
+    def records(self):
+        with open(self.output_path, encoding='utf-8') as f:
+            return {record['message_id']: record for record in map(json.loads, f)}
+
+    def test_no_client_or_encoding_until_needed(self):
+        # Responses that carry usage numbers need no tokenizer, so these tests run offline.
+        self.assertIsNone(prompt_example._client)
+        self.assertIsNone(prompt_example._encoding)
+
+    def test_rate_limit_is_retried(self):
+        stats = self.classify([('a', 'RATE_LIMIT notice')])
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(sum(MockServer.calls.values()), 3)
+        self.assertEqual(self.records()['a']['response'], ANSWER)
+
+    def test_server_error_fails_after_retries_and_resumes(self):
+        stats = self.classify([('a', 'first email'), ('b', 'SERVER_ERROR email')])
+        self.assertEqual((stats['completed'], stats['failed']), (1, 1))
+        self.assertEqual(sum(MockServer.calls.values()), 1 + 3)
+        self.assertIn('InternalServerError', self.records()['b']['error'])
+
+        # A rerun skips the finished email and tries the failed one again.
+        MockServer.failing = False
+        stats = self.classify([('a', 'first email'), ('b', 'SERVER_ERROR email')])
+        self.assertEqual((stats['skipped'], stats['completed'], stats['failed']), (1, 1, 0))
+        self.assertEqual(self.records()['b']['response'], ANSWER)
+
+    def test_resume_after_a_partial_line(self):
+        self.classify([('a', 'first email')])
+        with open(self.output_path, 'a', encoding='utf-8') as f:
+            f.write('{"message_id": "b", "respo')
+        stats = self.classify([('a', 'first email'), ('b', 'second email')])
+        self.assertEqual((stats['skipped'], stats['completed']), (1, 1))
+        self.assertEqual(sorted(self.records()), ['a', 'b'])
+
+    def test_duplicates_wait_for_the_first_answer(self):
+        cache = prompt_example.ResponseCache(os.path.join(self.tmp.name, 'cache.db'))
+        try:
+            stats = self.classify([(str(i), 'same campaign email') for i in range(5)], cache=cache)
+        finally:
+            cache.close()
+        self.assertEqual((stats['completed'], stats['cached']), (1, 4))
+        self.assertEqual(sum(MockServer.calls.values()), 1)
+
+
+# A stand-in for the files and batches endpoints. A batch reports in_progress on the first
+# poll and BatchServer.final_status after that. A request whose email contains FAIL_ME lands
+# in the error file and one containing DROP_ME in neither file. A batch that does not complete
+# answers only its first request, and a failed one has no output file at all.
+
+class BatchServer(BaseHTTPRequestHandler):
+    files = {}
+    batches = {}
+    final_status = 'completed'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['content-length']))
+        if self.path.endswith('/files'):
+            form = BytesParser(policy=default_policy).parsebytes(
+                b'content-type: ' + self.headers['content-type'].encode() + b'\r\n\r\n' + body)
+            data = next(part.get_payload(decode=True) for part in form.iter_parts()
+                        if part.get_param('name', header='content-disposition') == 'file')
+            return self._send({'id': self._store(data), 'object': 'file', 'bytes': len(data), 'created_at': 0,
+                               'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+        request = json.loads(body)
+        batch = {'id': f'batch-{len(self.batches)}', 'object': 'batch', 'endpoint': request['endpoint'],
+                 'input_file_id': request['input_file_id'], 'completion_window': '24h',
+                 'status': 'in_progress', 'created_at': 0, 'output_file_id': None, 'error_file_id': None}
+        self.batches[batch['id']] = batch
+        self._send(batch)
+
+    def do_GET(self):
+        if self.path.endswith('/content'):
+            return self._send(None, self.files[self.path.split('/')[-2]])
+        batch = self.batches[self.path.split('/')[-1]]
+        if batch['status'] == 'in_progress':
+            batch['status'] = self.final_status
+            self._finish(batch)
+        self._send(batch)
+
+    def _finish(self, batch):
+        requests = [json.loads(line) for line in self.files[batch['input_file_id']].decode().splitlines()]
+        if batch['status'] != 'completed':
+            requests = requests[:1]
+        output, errors = [], []
+        for request in requests:
+            email_content = request['body']['messages'][1]['content']
+            if 'DROP_ME' in email_content:
+                continue
+            if 'FAIL_ME' in email_content:
+                errors.append({'custom_id': request['custom_id'], 'response': None,
+                               'error': {'code': 'invalid_request', 'message': 'bad request'}})
+                continue
+            output.append({'custom_id': request['custom_id'], 'error': None, 'response': {
+                'status_code': 200,
+                'body': {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ANSWER}}],
+                         'usage': {'prompt_tokens': 100, 'completion_tokens': 10}},
+            }})
+        if batch['status'] != 'failed':
+            batch['output_file_id'] = self._store(''.join(json.dumps(line) + '\n' for line in output).encode())
+        if errors:
+            batch['error_file_id'] = self._store(''.join(json.dumps(line) + '\n' for line in errors).encode())
+
+    def _store(self, data):
+        file_id = f'file-{len(self.files)}'
+        self.files[file_id] = data
+        return file_id
+
+    def _send(self, payload, data=None):
+        data = data if data is not None else json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class RunBatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), BatchServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.client = prompt_example.OpenAI(api_key='test', base_url=f'http://127.0.0.1:{cls.server.server_address[1]}/v1')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        BatchServer.files = {}
+        BatchServer.batches = {}
+        BatchServer.final_status = 'completed'
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_batch(self, emails):
+        results_path = os.path.join(self.tmp.name, 'results.jsonl')
+        summary = prompt_example.run_batch(emails, os.path.join(self.tmp.name, 'batch.jsonl'), results_path,
+                                           batch_client=self.client, poll_interval=0.001, timeout=5)
+        with open(results_path, encoding='utf-8') as f:
+            return summary, {record['message_id']: record for record in map(json.loads, f)}
+
+    def test_round_trip(self):
+        emails = [('a', 'first email'), ('b', 'FAIL_ME email'), ('c', 'DROP_ME email'), ('a', 'first email again')]
+        summary, records = self.run_batch(emails)
+        self.assertEqual((summary['status'], summary['emails'], summary['failed']), ('completed', 3, 2))
+        self.assertEqual(records['a']['label'], {'Type': 1, 'Action': 1, 'detail': ''})
+        self.assertEqual(records['b']['error']['code'], 'invalid_request')
+        self.assertEqual(records['c']['error'], 'no result (batch completed)')
+
+    def test_expired_batch(self):
+        BatchServer.final_status = 'expired'
+        summary, records = self.run_batch([('a', 'first email'), ('b', 'second email')])
+        self.assertEqual((summary['status'], summary['failed']), ('expired', 1))
+        self.assertEqual(records['a']['response'], ANSWER)
+        self.assertEqual(records['b']['error'], 'no result (batch expired)')
+
+    def test_failed_batch(self):
+        BatchServer.final_status = 'failed'
+        summary, records = self.run_batch([('a', 'first email'), ('b', 'second email')])
+        self.assertEqual((summary['status'], summary['failed']), ('failed', 2))
+        self.assertEqual(records['a']['error'], 'no result (batch failed)')
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_evicts_least_recently_used(self):
+        cache = prompt_example.ResponseCache(self.path, max_entries=2)
+        cache.put('a', 'A', 1, 1)
+        cache.put('b', 'B', 1, 1)
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('b', 'B2', 1, 1)
+        cache.put('c', 'C', 1, 1)
+        self.assertEqual(cache.size(), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b')['response'], 'B2')
+        cache.close()
+
+        cache = prompt_example.ResponseCache(self.path, max_entries=2)
+        self.assertEqual(cache.size(), 2)
+        cache.close()
+
+    def test_hits_are_written_on_close(self):
+        cache = prompt_example.ResponseCache(self.path)
+        cache.put('a', 'A', 1, 1)
+        cache.put('b', 'B', 1, 1)
+        cache.get('a')
+        self.assertEqual(list(cache.pending_touches), ['a'])
+        cache.close()
+
+        cache = prompt_example.ResponseCache(self.path, max_entries=2)
+        cache.put('c', 'C', 1, 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()